@@ -8,20 +8,81 @@ import Data_Prepare
 
 project_dir = os.path.dirname(os.path.abspath(__file__))
 
+# При обучении на нескольких узлах каждый узел читает только свой шард (Data_Prepare.export_shards):
+# номер шарда задается переменной окружения SHARD, файлы шарда лежат в shards/shard_XXX
+shard = os.environ.get('SHARD')
+if shard is not None:
+    data_dir = os.path.join(project_dir, 'shards', Data_Prepare.SHARD_DIR_FORMAT.format(int(shard)))
+else:
+    data_dir = project_dir
+
 # Определите пути к файлам
-videos_file = os.path.join(project_dir, 'videos.npy')
-labels_file = os.path.join(project_dir, 'labels.npy')
-labels_names_file = os.path.join(project_dir, 'labels_names.npy')
+videos_file = os.path.join(data_dir, 'videos.npy')
+labels_file = os.path.join(data_dir, 'labels.npy')
+labels_names_file = os.path.join(data_dir, 'labels_names.npy')
+packed_dir = os.path.join(data_dir, 'videos_packed')
+compressed_file = os.path.join(data_dir, 'videos_compressed.npz')
+index_file = os.path.join(data_dir, 'videos_index.csv')
+stats_file = os.path.join(data_dir, 'videos_stats.json')
+
+if os.path.isfile(index_file):
+    # Индекс датасета (Data_Prepare.save_metadata_index): статистика без чтения кадров,
+    # videos.npy открывается через memmap и читается только при обращении к видео
+    index = Data_Prepare.load_metadata_index(index_file)
+    labels = np.array([[int(c) for c in code] for code in index['class_code']], dtype=np.int64).reshape(-1, 3)
+    label_names = index['label_name'].to_numpy()
+    videos = np.load(videos_file, mmap_mode='r') if os.path.isfile(videos_file) else None
+
+    print(f"Число видео: {len(index)}")
+    print(f"Размерность одного видео: {index['shape'].iloc[0] if len(index) else '-'}")   # Число кадров x Высота x Ширина x Глубина
+    print(f"Число кадров в видео: от {index['frames'].min()} до {index['frames'].max()}")
+    print(f"Объем видео: {index['size_bytes'].sum() / 2 ** 30:.2f} ГБ")
+    print(f"Размерность массива меток: {labels.shape}")
+
+    # Разбиение на обучающую и валидационную выборки с сохранением долей классов
+    train_indices, val_indices = Data_Prepare.split_metadata_index(index, val_fraction=0.2, seed=0)
+    print(f"Обучающая выборка: {len(train_indices)}, валидационная выборка: {len(val_indices)}")
+elif os.path.isdir(packed_dir):
+    # Упакованный датасет (Data_Prepare.save_packed_videos): кадры не читаются с диска, пока не понадобится видео
+    videos = Data_Prepare.PackedVideos(packed_dir)
+    labels = videos.labels
+    label_names = videos.label_names
+
+    print(f"Число видео: {len(videos)}")
+    print(f"Размерность одного видео: {videos[0].shape}")   # (Число кадров, Высота, Ширина, Глубина)
+    print(f"Число кадров в видео: от {videos.lengths.min()} до {videos.lengths.max()}")
+    print(f"Размерность массива меток: {labels.shape}")
+elif os.path.isfile(compressed_file):
+    # Сжатый датасет (Data_Prepare.save_compressed_videos): видео распаковывается только при обращении к нему
+    videos = Data_Prepare.CompressedVideos(compressed_file)
+    labels = videos.labels
+    label_names = videos.label_names
+
+    print(f"Число видео: {len(videos)}")
+    print(f"Размерность одного видео: {videos[0].shape}")   # (Число кадров, Высота, Ширина, Глубина)
+    print(f"Размерность массива меток: {labels.shape}")
+else:
+    # Загрузка массивов
+    videos = np.load(videos_file)
+    labels = np.load(labels_file)
+    label_names = np.load(labels_names_file)
 
-# Загрузка массивов
-videos = np.load(videos_file)
-labels = np.load(labels_file)
-label_names = np.load(labels_names_file)
+    # Проверка загруженных данных
+    print(f"Размерность массива видео: {videos.shape}")     # (Число видео, Число кадров, Высота, Ширина, Глубина)
+    print(f"Размерность одного видео: {videos[0].shape}")   # (Число кадров, Высота, Ширина, Глубина)
+    print(f"Размерность массива меток: {labels.shape}")
 
-# Проверка загруженных данных
-print(f"Размерность массива видео: {videos.shape}")     # (Число видео, Число кадров, Высота, Ширина, Глубина)
-print(f"Размерность одного видео: {videos[0].shape}")   # (Число кадров, Высота, Ширина, Глубина)
-print(f"Размерность массива меток: {labels.shape}")
+# Константы нормализации яркости (Data_Prepare.IntensityStats): сохраняются при загрузке видео, а если файла нет -
+# считаются за один проход по videos.npy без загрузки его в память
+intensity_stats = None
+if os.path.isfile(stats_file):
+    intensity_stats = Data_Prepare.IntensityStats.load_json(stats_file)
+elif os.path.isfile(index_file) and videos is not None:
+    intensity_stats = Data_Prepare.compute_intensity_stats(videos_file, label_names, index['frames'])
+    intensity_stats.save_json(stats_file)
+
+if intensity_stats is not None:
+    print(f"Яркость кадров: среднее {intensity_stats.mean():.2f}, стандартное отклонение {intensity_stats.std():.2f}")
 
 
 # Построение гистограммы
@@ -36,6 +97,25 @@ plt.tight_layout()
 plt.show()
 
 
+#----------------Подача клипов для обучения----------------#
+
+if os.path.isfile(index_file) and videos is not None:
+    # Клипы по 16 кадров: для обучения - случайные окна с равной долей классов, для валидации - все окна подряд.
+    # Видео читаются из videos.npy по одному клипу, следующие батчи готовятся в фоновых потоках
+    lengths = index['frames'].to_numpy()
+    train_sampler = Data_Prepare.ClipSampler(videos, labels, label_names, clip_length=16, batch_size=8,
+                                             indices=train_indices, lengths=lengths, mode='random', seed=0,
+                                             report_every=50)
+    val_sampler = Data_Prepare.ClipSampler(videos, labels, label_names, clip_length=16, batch_size=8,
+                                           indices=val_indices, lengths=lengths, mode='sliding')
+    print(f"Батчей за эпоху: обучение {len(train_sampler)}, валидация {len(val_sampler)}")
+
+    # for epoch in range(n_epochs):
+    #     for clips, batch_labels in train_sampler:
+    #         ...  # шаг обучения модели
+    #     print(f"Эпоха {epoch}: {train_sampler.samples_per_second():.1f} клипов/с")
+
+
 # left_count = np.sum([count for label, count in zip(unique_labels, label_counts) if 'left' in label])
 # right_count = np.sum([count for label, count in zip(unique_labels, label_counts) if 'right' in label])
 # categories = ['left', 'right']
@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import time
+import platform
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import cv2
+import numpy as np
+import Data_Prepare
+
+try:
+    import resource  # нет в Windows
+except ImportError:
+    resource = None
+
+
+def _raw_size(videos):
+    # Объем несжатых кадров в байтах
+    return sum(np.asarray(videos[i]).nbytes for i in range(len(videos)))
+
+
+def benchmark_storage_formats(videos, labels, label_names, work_dir, chunk_frames_list=(None, 16), compresslevel=6,
+                              random_reads=20, seed=0):
+    """
+    Сравнивает сохранение датасета через np.save (.npy) и save_compressed_videos (сжатый .npz по кускам):
+    размер файла, скорость записи, скорость чтения всего датасета и чтения случайных отдельных видео.
+    Скорости считаются в МБ/с несжатых кадров.
+
+    Параметры:
+        videos: Массив видео из load_videos (одинаковое число кадров во всех видео - для сравнения с .npy).
+        work_dir (str): Папка для временных файлов бенчмарка.
+        chunk_frames_list: Варианты chunk_frames для сжатого формата.
+        random_reads (int): Число случайных обращений к отдельным видео.
+
+    Возвращает:
+        list: Список словарей с результатами для каждого формата.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    raw_mb = _raw_size(videos) / 2 ** 20
+    rng = np.random.default_rng(seed)
+    random_indices = rng.integers(0, len(videos), size=random_reads)
+    results = []
+
+    # Обычный .npy
+    npy_file = os.path.join(work_dir, 'benchmark_videos.npy')
+    start = time.perf_counter()
+    np.save(npy_file, np.asarray(videos))
+    write_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    np.load(npy_file)
+    read_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    npy_videos = np.load(npy_file, mmap_mode='r')
+    for i in random_indices:
+        np.array(npy_videos[i])
+    random_time = time.perf_counter() - start
+    del npy_videos
+
+    results.append({
+        'format': 'npy',
+        'size_mb': os.path.getsize(npy_file) / 2 ** 20,
+        'write_mb_s': raw_mb / write_time,
+        'read_mb_s': raw_mb / read_time,
+        'random_read_ms': random_time / random_reads * 1000,
+    })
+    os.remove(npy_file)
+
+    # Сжатый .npz с разными размерами кусков
+    for chunk_frames in chunk_frames_list:
+        compressed_file = os.path.join(work_dir, 'benchmark_videos.npz')
+        start = time.perf_counter()
+        size = Data_Prepare.save_compressed_videos(videos, labels, label_names, compressed_file,
+                                                   chunk_frames=chunk_frames, compresslevel=compresslevel)
+        write_time = time.perf_counter() - start
+
+        compressed = Data_Prepare.CompressedVideos(compressed_file)
+        start = time.perf_counter()
+        for i in range(len(compressed)):
+            compressed[i]
+        read_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in random_indices:
+            compressed[i]
+        random_time = time.perf_counter() - start
+        compressed.close()
+
+        results.append({
+            'format': f"npz_chunk_{chunk_frames or 'video'}",
+            'size_mb': size / 2 ** 20,
+            'write_mb_s': raw_mb / write_time,
+            'read_mb_s': raw_mb / read_time,
+            'random_read_ms': random_time / random_reads * 1000,
+        })
+        os.remove(compressed_file)
+
+    print(f"Несжатый объем кадров: {raw_mb:.1f} МБ")
+    print(f"{'Формат':<20}{'Размер, МБ':>12}{'Запись, МБ/с':>15}{'Чтение, МБ/с':>15}{'Одно видео, мс':>17}")
+    for result in results:
+        print(f"{result['format']:<20}{result['size_mb']:>12.1f}{result['write_mb_s']:>15.1f}"
+              f"{result['read_mb_s']:>15.1f}{result['random_read_ms']:>17.2f}")
+
+    return results
+
+
+def write_synthetic_ct_video(video_path, n_frames, frame_size=(512, 512), fps=10, rng=None):
+    """
+    Записывает синтетическое видео, похожее на серию срезов МСКТ: черный фон, серое тело-эллипс, внутри -
+    более яркие органы, форма и положение которых плавно меняются от среза к срезу, и шум.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    width, height = frame_size
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+
+    body_axes = (int(width * rng.uniform(0.38, 0.46)), int(height * rng.uniform(0.28, 0.36)))
+    center = (width // 2 + int(rng.integers(-width // 40, width // 40 + 1)), height // 2)
+    organs = [(rng.uniform(0.15, 0.85), rng.uniform(0.3, 0.7), rng.uniform(0.03, 0.08), int(rng.integers(140, 230)))
+              for _ in range(6)]
+
+    for i in range(n_frames):
+        phase = i / max(n_frames - 1, 1)
+        frame = np.zeros((height, width), dtype=np.uint8)
+        cv2.ellipse(frame, center, body_axes, 0, 0, 360, 90, -1)
+        for x, y, r, intensity in organs:
+            radius = max(int(r * width * np.sin(np.pi * (phase * 0.8 + 0.1))), 1)
+            cv2.circle(frame, (int(x * width), int(y * height + 20 * np.sin(2 * np.pi * phase))), radius, intensity, -1)
+        frame = cv2.add(frame, rng.integers(0, 12, size=frame.shape, dtype=np.uint8))
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR))
+
+    writer.release()
+
+
+def generate_synthetic_dataset(base_path, videos_per_class=2, frame_range=(60, 60), frame_size=(512, 512), seed=0):
+    """
+    Создает синтетический датасет в структуре create_folder_structure (base_path/data/left_adrenal|right_adrenal/
+    class_X_Y_Z) с videos_per_class видео в каждой папке класса. Число кадров каждого видео выбирается случайно
+    из frame_range. По умолчанию все видео одной длины, чтобы load_videos без output_file и target_depth собирал
+    их в один массив; для видео разной длины, как в реальных сериях, задать, например, frame_range=(40, 80)
+    и загружать через output_file (см. benchmark_ingestion).
+
+    Возвращает:
+        str: Путь к папке data.
+    """
+    Data_Prepare.create_folder_structure(base_path)
+    data_dir = os.path.join(base_path, 'data')
+    rng = np.random.default_rng(seed)
+
+    for location in sorted(os.listdir(data_dir)):
+        for class_name in sorted(os.listdir(os.path.join(data_dir, location))):
+            for i in range(videos_per_class):
+                video_path = os.path.join(data_dir, location, class_name, f"SYN{i:04d}_{location}_{class_name}.mp4")
+                n_frames = int(rng.integers(frame_range[0], frame_range[1] + 1))
+                write_synthetic_ct_video(video_path, n_frames, frame_size, rng=rng)
+
+    return data_dir
+
+
+def peak_rss_bytes():
+    """
+    Пиковое потребление памяти текущим процессом в байтах (None, если модуль resource недоступен).
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _run_ingestion_case(data_dir, load_kwargs):
+    # Выполняется в отдельном процессе, чтобы пиковая память относилась только к одному запуску load_videos
+    frame_counts = []
+    start = time.perf_counter()
+    videos, labels, label_names = Data_Prepare.load_videos(data_dir, frame_counts=frame_counts, **load_kwargs)
+    elapsed = time.perf_counter() - start
+
+    # Объем результата - с кадрами дополнения, число оставленных кадров - без них
+    output_bytes = sum(np.asarray(video).nbytes for video in videos)
+    kept_frames = sum(frame_counts)
+    return elapsed, len(label_names), kept_frames, output_bytes, peak_rss_bytes()
+
+
+def benchmark_ingestion(data_dir, target_sizes=((112, 112), (224, 224)), frame_skips=(1, 2, 5),
+                        third_dimension_options=(False, True), results_file=None, repeats=1, **load_kwargs):
+    """
+    Измеряет load_videos на датасете data_dir для всех сочетаний target_size, frame_skip и add_third_dimension.
+    Каждый запуск выполняется в новом процессе. Для каждого сочетания сохраняется лучший из repeats запусков:
+        decoded_fps - исходных кадров в секунду (все кадры видео, включая пропущенные),
+        studies_per_s - видео в секунду,
+        peak_rss_mb - пиковое потребление памяти процесса,
+        output_mb - объем полученных массивов.
+
+    Параметры:
+        results_file (str): Путь к .jsonl-файлу. Результаты дописываются по одной JSON-строке на сочетание
+                            параметров (с датой и платформой), чтобы сравнивать запуски во времени.
+        load_kwargs: Дополнительные параметры load_videos (например, workers, dual_side, target_depth).
+                     Видео разной длины собираются в один массив только через output_file или target_depth.
+
+    Возвращает:
+        list: Список словарей с результатами.
+    """
+    source_counts = [Data_Prepare.probe_video_frame_count(video_path, 1)
+                     for video_path, _, _ in Data_Prepare.collect_video_tasks(data_dir)]
+    source_frames = sum(source_counts)
+    if (len(set(source_counts)) > 1 and load_kwargs.get('output_file') is None
+            and load_kwargs.get('target_depth') is None):
+        raise ValueError("Видео разной длины: для benchmark_ingestion нужен output_file или target_depth")
+    run_id = datetime.now().isoformat(timespec='seconds')
+    spawn_context = multiprocessing.get_context('spawn')
+    results = []
+
+    for target_size in target_sizes:
+        for frame_skip in frame_skips:
+            for add_third_dimension in third_dimension_options:
+                kwargs = dict(load_kwargs, target_size=tuple(target_size), frame_skip=frame_skip,
+                              add_third_dimension=add_third_dimension)
+                runs = []
+                for _ in range(repeats):
+                    with ProcessPoolExecutor(max_workers=1, mp_context=spawn_context) as executor:
+                        runs.append(executor.submit(_run_ingestion_case, data_dir, kwargs).result())
+                elapsed, studies, kept_frames, output_bytes, peak_rss = min(runs)
+
+                result = {
+                    'run_id': run_id,
+                    'platform': platform.platform(),
+                    'target_size': list(target_size),
+                    'frame_skip': frame_skip,
+                    'add_third_dimension': add_third_dimension,
+                    'load_kwargs': dict(load_kwargs),
+                    'studies': studies,
+                    'source_frames': source_frames,
+                    'kept_frames': kept_frames,
+                    'seconds': elapsed,
+                    'decoded_fps': source_frames / elapsed,
+                    'studies_per_s': studies / elapsed,
+                    'peak_rss_mb': peak_rss / 2 ** 20 if peak_rss is not None else None,
+                    'output_mb': output_bytes / 2 ** 20,
+                }
+                results.append(result)
+                peak_text = f"{result['peak_rss_mb']:.0f}" if peak_rss is not None else '-'
+                print(f"size={target_size[0]}x{target_size[1]} skip={frame_skip} 3d={int(add_third_dimension)}: "
+                      f"{result['decoded_fps']:.0f} кадров/с, {result['studies_per_s']:.1f} видео/с, "
+                      f"пик памяти {peak_text} МБ, результат {result['output_mb']:.1f} МБ")
+
+    if results_file is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(results_file)), exist_ok=True)
+        with open(results_file, 'a', encoding='utf-8') as f:
+            for result in results:
+                f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+    return results
+
+
+if __name__ == "__main__":
+    project_dir = os.path.dirname(os.path.abspath(__file__))
+    benchmark_dir = os.path.join(project_dir, 'benchmark')
+
+#----------------Скорость загрузки видео на синтетическом датасете----------------#
+
+    # Видео одинаковой длины, чтобы load_videos без target_depth собирал их в один массив
+    synthetic_dir = os.path.join(benchmark_dir, 'synthetic')
+    if not os.path.isdir(os.path.join(synthetic_dir, 'data')):
+        generate_synthetic_dataset(synthetic_dir, videos_per_class=2)
+
+    benchmark_ingestion(os.path.join(synthetic_dir, 'data'), results_file=os.path.join(benchmark_dir, 'ingestion.jsonl'))
+    # Конвейерная загрузка (потоки декодирования и обработки) для сравнения с последовательной
+    benchmark_ingestion(os.path.join(synthetic_dir, 'data'), results_file=os.path.join(benchmark_dir, 'ingestion.jsonl'),
+                        pipeline_threads=(2, 2))
+
+    # Видео разной длины, как в реальных сериях: кадры пишутся в .npy (output_file), короткие дополняются нулями
+    ragged_dir = os.path.join(benchmark_dir, 'synthetic_ragged')
+    if not os.path.isdir(os.path.join(ragged_dir, 'data')):
+        generate_synthetic_dataset(ragged_dir, videos_per_class=2, frame_range=(40, 80))
+
+    benchmark_ingestion(os.path.join(ragged_dir, 'data'), results_file=os.path.join(benchmark_dir, 'ingestion.jsonl'),
+                        output_file=os.path.join(benchmark_dir, 'ragged_videos.npy'))
+
+#----------------Форматы хранения массивов----------------#
+
+    # videos = np.load(os.path.join(project_dir, 'videos.npy'), mmap_mode='r')
+    # labels = np.load(os.path.join(project_dir, 'labels.npy'))
+    # label_names = np.load(os.path.join(project_dir, 'labels_names.npy'))
+    #
+    # benchmark_storage_formats(videos, labels, label_names, benchmark_dir)
@@ -2,8 +2,16 @@ import os
 import pandas as pd
 import requests
 import shutil
+import hashlib
+import zipfile
+import io
+import json
+import time
 import cv2
 import numpy as np
+import threading
+import queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 def create_folder_structure(base_path:str) -> None:
     """
@@ -40,12 +48,40 @@ def create_folder_structure(base_path:str) -> None:
     print(f"Структура папок успешно создана в: {os.path.join(base_path, 'data')}")
 
 
-def check_images_in_excel(image_dir, excel_file, column_d='Файл c нативной фазой', column_t='Присутствует в папке "Все картинки"'):
+def reconcile_images_with_excel(image_names, excel_names):
+    """
+    Сопоставляет имена файлов из папки (с расширением) с именами из Excel (без расширения) за один проход
+    через множества.
+
+    Возвращает:
+        matched (set): Имена (без расширения), которые есть и в папке, и в Excel.
+        missing_from_excel (list): Файлы из папки (с расширением), которых нет в Excel, в порядке image_names.
+        missing_from_folder (set): Имена из Excel, для которых нет файла в папке.
+    """
+    excel_set = set(excel_names)
+    base_names = {image_name: os.path.splitext(image_name)[0] for image_name in image_names}
+    folder_set = set(base_names.values())
+
+    matched = folder_set & excel_set
+    missing_from_excel = [image_name for image_name, base_name in base_names.items() if base_name not in excel_set]
+    missing_from_folder = excel_set - folder_set
+
+    return matched, missing_from_excel, missing_from_folder
+
+
+def check_images_in_excel(image_dir, excel_file, column_d='Файл c нативной фазой', column_t='Присутствует в папке "Все картинки"',
+                          sidecar_file=None, missing_from_folder=None):
     """
     Функция проверяет, присутствуют ли имена картинок из папки в Excel-файле и обновляет Excel:
     - Если имя картинки найдено в столбце D, ставит 1 в столбце T.
     - Картинки, не найденные в Excel, записывает в отдельный список.
 
+    Параметры:
+        sidecar_file (str): Путь к .csv или .parquet. Если задан, столбцы D и T сохраняются в этот файл,
+                            а сам Excel-файл не перезаписывается.
+        missing_from_folder (list): Если передан, в него добавляются (по алфавиту) имена из столбца D,
+                                    для которых нет картинки в папке. Пустые ячейки не учитываются.
+
     Возвращает:
         missing_images (list): Список картинок, которые не найдены в Excel-файле.
     """
@@ -72,29 +108,29 @@ def check_images_in_excel(image_dir, excel_file, column_d='Файл c натив
         print(f"Ошибка: В Excel-файле нет столбцов '{column_d}' или '{column_t}'.")
         return []
 
-    # Преобразуем имена картинок из столбца D в список для удобства поиска
-    excel_images = df[column_d].astype(str).tolist()
+    # Сопоставляем имена картинок и столбец D через множества вместо поиска по списку для каждой картинки
+    # Пустые ячейки отбрасываем до astype(str), иначе они превращаются в строку 'nan'
+    excel_images = df[column_d].dropna().astype(str)
+    matched, missing_images, not_in_folder = reconcile_images_with_excel(os.listdir(image_dir), excel_images)
 
-    # Список картинок, которые не найдены в Excel
-    missing_images = []
+    # Ставим 1 в столбец T для всех найденных картинок одной операцией
+    df.loc[excel_images.index[excel_images.isin(matched)], column_t] = 1
 
-    # Проходим по всем картинкам в папке
-    for image_name in os.listdir(image_dir):
-        # Убираем расширение файла (например, .jpg или .png) для сравнения
-        image_base_name = os.path.splitext(image_name)[0]
-
-        if image_base_name in excel_images:
-            # Если имя картинки найдено, ставим 1 в столбец T
-            df.loc[df[column_d] == image_base_name, column_t] = 1
-        else:
-            # Если не найдено, добавляем в список
-            missing_images.append(image_name)
+    print(f"Найдено в Excel: {len(matched)}, нет в Excel: {len(missing_images)}, "
+          f"нет в папке: {len(not_in_folder)}")
+    if missing_from_folder is not None:
+        missing_from_folder.extend(sorted(not_in_folder))
 
-    # Попытка сохранить Excel-файл
+    # Попытка сохранить результат
     try:
-        df.to_excel(excel_file, index=False)
+        if sidecar_file is None:
+            df.to_excel(excel_file, index=False)
+        elif sidecar_file.endswith('.parquet'):
+            df[[column_d, column_t]].to_parquet(sidecar_file, index=False)
+        else:
+            df[[column_d, column_t]].to_csv(sidecar_file, index=False)
     except Exception as e:
-        print(f"Ошибка при сохранении Excel-файла: {e}")
+        print(f"Ошибка при сохранении файла: {e}")
         return []
 
     return missing_images
@@ -139,7 +175,8 @@ def test_download_and_display_single_video(excel_file, column_names):
                 # Сохранение загруженного видео во временный файл
                 temp_file = 'temp_video.mp4'
                 with open(temp_file, 'wb') as f:
-                    f.write(response.content)
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
 
                 file_size = os.path.getsize(temp_file)
                 print(f"Размер загруженного файла: {file_size} байт")
@@ -171,296 +208,2884 @@ def test_download_and_display_single_video(excel_file, column_names):
             print(f"Ошибка загрузки файла: {e}")
             continue
 
-def display_video(video_path, frame_skip=5, wait_key=200):
+class IngestStats:
+    """
+    Счетчики и время по этапам обработки видео для поиска узких мест загрузки.
+    Передается как stats в load_videos, process_video, read_sampled_frames, transform_frame и display_*.
+    Если stats не передан (None), замеры не выполняются (в горячем цикле используется NULL_INGEST_STATS).
+
+    Этапы (секунды): open - открытие cv2.VideoCapture, decode - cap.read()/cap.grab(), crop - обрезка половины кадра,
+    gray - cv2.cvtColor, resize - cv2.resize, stack - сборка np.array из кадров, cache - чтение из кэша,
+    stack_all - сборка итогового массива всех видео в load_videos.
+    Счетчики: frames_decoded - кадров прочитано из видео (включая пропущенные), frames_kept - кадров оставлено,
+    bytes_produced - байт в обработанных кадрах.
+    Замеры и счетчики вне start_video (например, прямой вызов transform_frame) относятся ко всей загрузке
+    (pipeline, pipeline_counters) и входят в totals().
+    """
+
+    COUNTERS = ('frames_decoded', 'frames_kept', 'bytes_produced')
+
+    def __init__(self):
+        self.videos = {}
+        self.pipeline = {}  # Этапы, которые относятся ко всей загрузке, а не к одному видео
+        self.pipeline_counters = {counter: 0 for counter in self.COUNTERS}  # Счетчики вне start_video
+        self.current = None
+
+    def start_video(self, video_path):
+        # Все последующие замеры относятся к этому видео
+        if video_path not in self.videos:
+            self.videos[video_path] = {'stages': {}, **{counter: 0 for counter in self.COUNTERS}}
+        self.current = self.videos[video_path]
+
+    def add_time(self, stage, seconds):
+        stages = self.current['stages'] if self.current is not None else self.pipeline
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+    def count(self, counter, value=1):
+        counters = self.current if self.current is not None else self.pipeline_counters
+        counters[counter] += value
+
+    def timer(self, stage):
+        """
+        Замер этапа блоком with: with stats.timer('resize'): ...
+        """
+        return _StageTimer(self, stage)
+
+    def merge(self, data):
+        """
+        Добавляет результаты другого IngestStats (в виде to_dict()), например, из процесса-обработчика.
+        """
+        for video_path, video in data['videos'].items():
+            self.start_video(video_path)
+            for stage, seconds in video['stages'].items():
+                self.add_time(stage, seconds)
+            for counter in self.COUNTERS:
+                self.count(counter, video[counter])
+        self.current = None
+        for stage, seconds in data['pipeline'].items():
+            self.pipeline[stage] = self.pipeline.get(stage, 0.0) + seconds
+        for counter, value in data.get('pipeline_counters', {}).items():
+            self.pipeline_counters[counter] += value
+
+    def totals(self):
+        """
+        Возвращает:
+            dict: Суммарное время по этапам и суммарные счетчики по всем видео.
+        """
+        total = {'videos': len(self.videos), 'stages': dict(self.pipeline), **self.pipeline_counters}
+        for video in self.videos.values():
+            for stage, seconds in video['stages'].items():
+                total['stages'][stage] = total['stages'].get(stage, 0.0) + seconds
+            for counter in self.COUNTERS:
+                total[counter] += video[counter]
+        return total
+
+    def to_dict(self):
+        return {'videos': self.videos, 'pipeline': self.pipeline, 'pipeline_counters': self.pipeline_counters,
+                'total': self.totals()}
+
+    def save_json(self, json_file):
+        with open(json_file, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+
+class _StageTimer:
+    # Контекстный менеджер IngestStats.timer: добавляет время блока к этапу stage
+    __slots__ = ('stats', 'stage', 'start')
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.stage, time.perf_counter() - self.start)
+
+
+class _NullIngestStats:
+    # Заглушка IngestStats для stats=None: один и тот же код обработки кадров работает с замерами и без них,
+    # а без замеров каждый вызов ничего не делает
+
+    def start_video(self, video_path):
+        pass
+
+    def add_time(self, stage, seconds):
+        pass
+
+    def count(self, counter, value=1):
+        pass
+
+    def timer(self, stage):
+        return self
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_INGEST_STATS = _NullIngestStats()
+
+
+class IntensityStats:
+    """
+    Потоковая статистика яркости кадров для нормализации: среднее, стандартное отклонение и гистограмма
+    с фиксированными бинами - по всему датасету и по каждому классу (label_names, 'left_001').
+    Кадры добавляются кусками (update), поэтому весь датасет в памяти не нужен. Среднее и сумма квадратов
+    отклонений каждого куска объединяются с накопленными по формуле Чана (обобщение алгоритма Уэлфорда), что
+    численно устойчиво на любом числе пикселей. Частичные результаты из процессов-обработчиков объединяются
+    через merge(to_dict()), как в IngestStats.
+
+    Параметры:
+        bins (int): Число бинов гистограммы.
+        value_range (tuple): Диапазон значений гистограммы [min, max). По умолчанию - один бин на уровень uint8.
+    """
+
+    def __init__(self, bins=256, value_range=(0, 256)):
+        self.bins = bins
+        self.value_range = tuple(value_range)
+        self.total = self._empty()
+        self.classes = {}
+
+    def _empty(self):
+        return {'count': 0, 'mean': 0.0, 'm2': 0.0, 'histogram': np.zeros(self.bins, dtype=np.int64)}
+
+    @staticmethod
+    def _combine(target, count, mean, m2, histogram):
+        # Объединение моментов двух частей (формула Чана)
+        total_count = target['count'] + count
+        if total_count == 0:
+            return
+        delta = mean - target['mean']
+        target['mean'] += delta * count / total_count
+        target['m2'] += m2 + delta ** 2 * target['count'] * count / total_count
+        target['count'] = total_count
+        target['histogram'] += histogram
+
+    def update(self, frames, label_name=None):
+        """
+        Добавляет кусок кадров (массив любой формы). Для uint8 моменты считаются точно по np.bincount,
+        без перевода куска в float64.
+        """
+        frames = np.asarray(frames)
+        if frames.size == 0:
+            return
+
+        if frames.dtype == np.uint8:
+            values = np.arange(256, dtype=np.float64)
+            counts = np.bincount(frames.ravel(), minlength=256)
+            count = int(counts.sum())
+            mean = float(counts @ values) / count
+            m2 = float(counts @ (values - mean) ** 2)
+            if self.value_range == (0, 256) and self.bins == 256:
+                histogram = counts
+            else:
+                histogram = np.histogram(values, self.bins, self.value_range, weights=counts)[0].astype(np.int64)
+        else:
+            values = frames.astype(np.float64).ravel()
+            count = values.size
+            mean = float(values.mean())
+            m2 = float(((values - mean) ** 2).sum())
+            histogram = np.histogram(values, self.bins, self.value_range)[0]
+
+        self._combine(self.total, count, mean, m2, histogram)
+        if label_name is not None:
+            self._combine(self.classes.setdefault(str(label_name), self._empty()), count, mean, m2, histogram)
+
+    def merge(self, data):
+        """
+        Добавляет результаты другого IntensityStats (в виде to_dict()), например, из процесса-обработчика.
+        """
+        self._combine(self.total, data['total']['count'], data['total']['mean'], data['total']['m2'],
+                      np.asarray(data['total']['histogram'], dtype=np.int64))
+        for label_name, part in data['classes'].items():
+            self._combine(self.classes.setdefault(label_name, self._empty()), part['count'], part['mean'],
+                          part['m2'], np.asarray(part['histogram'], dtype=np.int64))
+
+    def mean(self, label_name=None):
+        return (self.classes[label_name] if label_name is not None else self.total)['mean']
+
+    def std(self, label_name=None):
+        part = self.classes[label_name] if label_name is not None else self.total
+        return float(np.sqrt(part['m2'] / part['count'])) if part['count'] > 0 else 0.0
+
+    def to_dict(self):
+        def part_dict(part, label_name=None):
+            return {'count': part['count'], 'mean': part['mean'], 'std': self.std(label_name), 'm2': part['m2'],
+                    'histogram': part['histogram'].tolist()}
+
+        return {'bins': self.bins, 'value_range': list(self.value_range), 'total': part_dict(self.total),
+                'classes': {name: part_dict(part, name) for name, part in sorted(self.classes.items())}}
+
+    def save_json(self, json_file):
+        """
+        Сохраняет константы нормализации (mean, std) и гистограммы рядом с массивами. Загрузка - load_json.
+        """
+        with open(json_file, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+
+    @classmethod
+    def load_json(cls, json_file):
+        with open(json_file, encoding='utf-8') as f:
+            data = json.load(f)
+        stats = cls(data['bins'], data['value_range'])
+        stats.merge(data)
+        return stats
+
+
+def _imap_tasks(func, task_args, workers=None):
+    # Вызывает func(*args) для каждого набора аргументов: в workers процессах (ProcessPoolExecutor.map сохраняет
+    # порядок результатов) или последовательно в текущем процессе, если workers - None или 1.
+    # Результаты отдаются по мере готовности, не накапливаясь в списке.
+    # func должна быть функцией уровня модуля, чтобы ее можно было передать в процессы
+    task_args = list(task_args)
+    if workers is not None and workers > 1 and task_args:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(func, *zip(*task_args))
+    else:
+        for args in task_args:
+            yield func(*args)
+
+
+def _map_tasks(func, task_args, workers=None):
+    # То же, что _imap_tasks, но возвращает список результатов
+    return list(_imap_tasks(func, task_args, workers))
+
+
+def _imap_ingest_tasks(func, task_args, workers=None, stats=None):
+    # Выполняет задачи загрузки видео (_process_video_task, _write_video_task) через _imap_tasks.
+    # Если stats задан, задачи запущены с collect_stats=True и возвращают (результат, IngestStats.to_dict()):
+    # замеры процессов объединяются в stats, а наружу отдается только результат
+    for result in _imap_tasks(func, [(args,) for args in task_args], workers):
+        if stats is not None:
+            stats.merge(result[1])
+            result = result[0]
+        yield result
+
+
+def _intensity_stats_part(videos_file, indices, label_names, lengths, chunk_frames, bins, value_range):
+    # Статистика части видео; каждый процесс открывает .npy через memmap
+    videos = np.load(videos_file, mmap_mode='r')
+    stats = IntensityStats(bins, value_range)
+    for i, label_name, length in zip(indices, label_names, lengths):
+        for start in range(0, length, chunk_frames):
+            stats.update(videos[i, start:min(start + chunk_frames, length)], label_name)
+    return stats.to_dict()
+
+
+def compute_intensity_stats(videos_file, label_names, lengths=None, chunk_frames=64, workers=None, bins=256,
+                            value_range=(0, 256)):
+    """
+    Считает IntensityStats за один проход по videos.npy, открытому через np.memmap, кусками по chunk_frames кадров
+    одного видео, так что в памяти одновременно не больше одного куска на процесс. С workers > 1 видео делятся
+    между процессами, частичные результаты объединяются (IntensityStats.merge).
+
+    Параметры:
+        label_names: Имена меток видео (labels_names.npy).
+        lengths: Настоящее число кадров каждого видео (например, index['frames'] из save_metadata_index), чтобы
+                 нулевые кадры дополнения не попадали в статистику. По умолчанию - все кадры массива.
+
+    Возвращает:
+        IntensityStats: Статистика датасета и классов.
+    """
+    videos = np.load(videos_file, mmap_mode='r')
+    n_videos, max_frames = videos.shape[0], videos.shape[1]
+    del videos
+
+    label_names = [str(name) for name in label_names]
+    lengths = [int(length) for length in lengths] if lengths is not None else [max_frames] * n_videos
+
+    n_parts = workers if workers is not None and workers > 1 else 1
+    task_args = []
+    for indices in np.array_split(np.arange(n_videos), n_parts):
+        task_args.append((videos_file, indices.tolist(), [label_names[i] for i in indices],
+                          [lengths[i] for i in indices], chunk_frames, bins, value_range))
+
+    stats = IntensityStats(bins, value_range)
+    for part in _map_tasks(_intensity_stats_part, task_args, n_parts):
+        stats.merge(part)
+
+    print(f"Яркость кадров: среднее {stats.mean():.2f}, стандартное отклонение {stats.std():.2f}")
+
+    return stats
+
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def make_download_session(workers=4):
+    """
+    Создает requests.Session с пулом соединений на workers потоков, чтобы соединения с сервером
+    переиспользовались между файлами. workers=None - одно соединение (последовательная загрузка).
+    """
+    pool_size = max(workers or 1, 1)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def file_checksum(file_path, algorithm='md5'):
+    # Контрольная сумма файла, читается кусками
+    digest = hashlib.new(algorithm)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_range_total(content_range):
+    # Полный размер файла из заголовка Content-Range ('bytes 0-99/1234' или 'bytes */1234'), None - если неизвестен
+    if not content_range or '/' not in content_range:
+        return None
+    total = content_range.rsplit('/', 1)[1].strip()
+    return int(total) if total.isdigit() else None
+
+
+def download_file(session, url, target_path, expected_size=None, expected_checksum=None, checksum_algorithm='md5',
+                  retries=3, timeout=30, backoff=1.0):
+    """
+    Потоково загружает файл по url в target_path кусками по DOWNLOAD_CHUNK_SIZE, не держа файл в памяти.
+    Данные пишутся в target_path + '.part'; если загрузка прервалась, следующая попытка (или следующий запуск)
+    продолжает ее через HTTP Range. После загрузки проверяются размер (Content-Length или expected_size) и
+    контрольная сумма, и только затем файл переименовывается в target_path.
+
+    Возвращает:
+        bool: True, если файл загружен и прошел проверку.
+    """
+    part_path = target_path + '.part'
+
+    for attempt in range(1, retries + 1):
+        try:
+            downloaded = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {'Range': f"bytes={downloaded}-"} if downloaded else {}
+
+            with session.get(url, stream=True, timeout=timeout, headers=headers) as response:
+                if response.status_code == 416:
+                    # Запрошенный диапазон за концом файла: .part содержит весь файл, только если его размер
+                    # совпадает с полным размером из Content-Range (bytes */N). Иначе .part устарел - загружаем заново
+                    total_size = content_range_total(response.headers.get('Content-Range'))
+                    if total_size != downloaded:
+                        os.remove(part_path)
+                        raise ValueError(f"размер .part {downloaded} байт, сервер сообщил {total_size}")
+                elif response.status_code in (200, 206):
+                    if response.status_code == 200:
+                        # Сервер не поддерживает Range - загружаем заново
+                        downloaded = 0
+                    content_length = response.headers.get('Content-Length')
+                    total_size = downloaded + int(content_length) if content_length is not None else None
+
+                    with open(part_path, 'ab' if downloaded else 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+                else:
+                    print(f"Ошибка при загрузке файла {url}: {response.status_code}")
+                    if response.status_code < 500:
+                        return False
+                    raise requests.HTTPError(f"статус {response.status_code}")
+
+            # При несовпадении размера .part удаляется, как и при несовпадении контрольной суммы,
+            # иначе каждая следующая попытка продолжала бы испорченный файл
+            file_size = os.path.getsize(part_path)
+            if expected_size is not None and file_size != expected_size:
+                os.remove(part_path)
+                raise ValueError(f"размер {file_size} байт, ожидалось {expected_size}")
+            if total_size is not None and file_size != total_size:
+                os.remove(part_path)
+                raise ValueError(f"размер {file_size} байт, сервер сообщил {total_size}")
+
+            if expected_checksum is not None and file_checksum(part_path, checksum_algorithm) != expected_checksum:
+                os.remove(part_path)
+                raise ValueError("контрольная сумма не совпадает")
+
+            os.replace(part_path, target_path)
+            return True
+
+        except (requests.RequestException, ValueError, OSError) as e:
+            print(f"Ошибка загрузки {url} (попытка {attempt} из {retries}): {e}")
+            if attempt < retries:
+                time.sleep(backoff * 2 ** (attempt - 1))
+
+    return False
+
+
+def download_videos_from_excel(excel_file, output_dir, column_names=('Файл c нативной фазой',),
+                               link_column='Местоположение файлов', workers=4, size_column=None,
+                               checksum_column=None, checksum_algorithm='md5', retries=3, timeout=30):
+    """
+    Загружает все видео, перечисленные в Excel-файле: ссылка на файл - '{link_column}/{имя из column_names}.mp4'.
+    Файлы загружаются параллельно в workers потоках через общий requests.Session с пулом соединений, потоково,
+    каждый в свой файл output_dir/<имя>.mp4, с повторами и продолжением прерванных загрузок (см. download_file).
+    Уже загруженные файлы пропускаются. Файл, который указан в таблице несколько раз (например, одно исследование
+    в строках левого и правого надпочечника), загружается один раз.
+
+    Параметры:
+        size_column (str): Столбец с ожидаемым размером файла в байтах (необязательно).
+        checksum_column (str): Столбец с ожидаемой контрольной суммой checksum_algorithm (необязательно).
+
+    Возвращает:
+        list: Список файлов, которые не удалось загрузить.
+    """
+    try:
+        df = pd.read_excel(excel_file)
+    except Exception as e:
+        print(f"Ошибка при чтении файла Excel: {e}")
+        return []
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Одна загрузка на target_path: иначе два потока пишут в один и тот же .part
+    downloads = {}
+    for _, row in df.iterrows():
+        base_link = str(row[link_column]).rstrip('/')
+        for col_name in column_names:
+            if pd.isna(row[col_name]):
+                continue
+            file_name = f"{row[col_name]}.mp4"
+            target_path = os.path.join(output_dir, file_name)
+            if target_path in downloads:
+                continue
+            expected_size = int(row[size_column]) if size_column is not None and pd.notna(row[size_column]) else None
+            expected_checksum = (str(row[checksum_column]).lower()
+                                 if checksum_column is not None and pd.notna(row[checksum_column]) else None)
+
+            if os.path.exists(target_path) and (expected_size is None or os.path.getsize(target_path) == expected_size):
+                print(f"Видео {file_name} уже загружено")
+                continue
+
+            downloads[target_path] = (file_name, f"{base_link}/{file_name}", target_path, expected_size,
+                                      expected_checksum)
+    downloads = list(downloads.values())
+
+    session = make_download_session(workers)
+
+    def download(item):
+        file_name, url, target_path, expected_size, expected_checksum = item
+        ok = download_file(session, url, target_path, expected_size, expected_checksum, checksum_algorithm,
+                           retries, timeout)
+        if ok:
+            print(f"Видео {file_name} загружено в {target_path}")
+        return ok
+
+    with session:
+        if workers is not None and workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(download, downloads))
+        else:
+            results = [download(item) for item in downloads]
+
+    failed_files = [item[0] for item, ok in zip(downloads, results) if not ok]
+    print(f"Загружено: {results.count(True)}, не удалось загрузить: {len(failed_files)}")
+
+    return failed_files
+
+
+def read_sampled_frames(cap, frame_skip=5, stats=None):
+    """
+    Генератор, который возвращает каждый {frame_skip} кадр из открытого cv2.VideoCapture.
+    Пропускаемые кадры только захватываются через cap.grab() без retrieve, т.е. без преобразования в BGR-изображение
+    и копирования в numpy-массив. Результат совпадает с чтением всех кадров через cap.read() и отбором каждого
+    {frame_skip} кадра. Если передан stats (IngestStats), считается время этапа decode и число кадров.
+
+    Возвращает (yield):
+        (frame_count, frame): Номер кадра в видео и сам кадр.
+    """
+    stats = stats if stats is not None else NULL_INGEST_STATS
+
+    frame_count = 0
+    while cap.isOpened():
+        if frame_count % frame_skip == 0:
+            with stats.timer('decode'):
+                ret, frame = cap.read()
+            if not ret:
+                break  # Конец видео
+            stats.count('frames_decoded')
+            stats.count('frames_kept')
+            yield frame_count, frame
+        else:
+            with stats.timer('decode'):
+                ret = cap.grab()
+            if not ret:
+                break  # Конец видео
+            stats.count('frames_decoded')
+
+        frame_count += 1
+
+
+def open_video(video_path, stats=None):
+    """
+    Открывает видео через cv2.VideoCapture. Если передан stats (IngestStats), начинает замеры для этого видео
+    и считает время этапа open.
+    """
+    stats = stats if stats is not None else NULL_INGEST_STATS
+    stats.start_video(video_path)
+    with stats.timer('open'):
+        cap = cv2.VideoCapture(video_path)
+    return cap
+
+def display_video(video_path, frame_skip=5, wait_key=200, stats=None):
     """
     Функция для воспроизведения каждого {frame_skip} кадра видео с задержкой  {wait_key} мс.
+    stats (IngestStats) - необязательные замеры открытия и декодирования видео.
     """
-    cap = cv2.VideoCapture(video_path)
+    cap = open_video(video_path, stats)
     if not cap.isOpened():
         print(f"Не удалось открыть видеофайл: {video_path}")
         return
 
-    frame_count = 0  # Счётчик кадров
     window_name = 'Display_video'
 
 
-    while cap.isOpened():
-        ret, frame = cap.read()
-
-        if not ret:
-            break  # Конец видео
-
-        if frame_count % frame_skip == 0:
-            cv2.imshow(window_name, frame) # Отображение кадра в одном и том же окне
-
-            # Задержка между кадрами и Остановка при нажатии клавиши 'q'
-            if cv2.waitKey(wait_key) & 0xFF == ord('q'):
-                break
+    for _, frame in read_sampled_frames(cap, frame_skip, stats):
+        cv2.imshow(window_name, frame) # Отображение кадра в одном и том же окне
 
-        frame_count += 1
+        # Задержка между кадрами и Остановка при нажатии клавиши 'q'
+        if cv2.waitKey(wait_key) & 0xFF == ord('q'):
+            break
 
     # Освобождение ресурсов
     cap.release()
     cv2.destroyAllWindows()
 
 # плохо работает
-def display_video_with_max_contour(video_path, frame_skip=5, wait_key=400):
+def display_video_with_max_contour(video_path, frame_skip=5, wait_key=400, stats=None):
     """
     Функция находит максимальный контур на каждом {frame_skip} кадре,
     проводит вертикальную линию через центр контура и выводит кадры в одном окне, чтобы убедиться, что центр найден
+    stats (IngestStats) - необязательные замеры открытия и декодирования видео.
     """
 
-    cap = cv2.VideoCapture(video_path)
+    cap = open_video(video_path, stats)
     if not cap.isOpened():
         print(f"Не удалось открыть видеофайл: {video_path}")
         return
 
     window_name = 'Display_video'
-    frame_count = 0
-
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
 
-        if frame_count % frame_skip == 0:
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-            # Применяем размытие
-            blurred = cv2.GaussianBlur(gray, (9, 9), 5)
+    for _, frame in read_sampled_frames(cap, frame_skip, stats):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 
-            # Используем Canny для выделения границ
-            edges = cv2.Canny(blurred, 50, 100)
+        # Применяем размытие
+        blurred = cv2.GaussianBlur(gray, (9, 9), 5)
 
-            contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # Используем Canny для выделения границ
+        edges = cv2.Canny(blurred, 50, 100)
 
-            if contours:
-                largest_contour = max(contours, key=cv2.contourArea)
+        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-                # Получаем момент для нахождения центра
-                M = cv2.moments(largest_contour)
-                if M["m00"] != 0:
-                    center_x = int(M["m10"] / M["m00"])
-                    center_y = int(M["m01"] / M["m00"])
+        if contours:
+            largest_contour = max(contours, key=cv2.contourArea)
 
-                    # Рисуем контур и линию на кадре
-                    cv2.drawContours(frame, [largest_contour], -1, (0, 255, 0), 2)
-                    cv2.line(frame, (center_x, 0), (center_x, frame.shape[0]), (255, 0, 0), 2)
+            # Получаем момент для нахождения центра
+            M = cv2.moments(largest_contour)
+            if M["m00"] != 0:
+                center_x = int(M["m10"] / M["m00"])
+                center_y = int(M["m01"] / M["m00"])
 
-            cv2.imshow(window_name, frame)
+                # Рисуем контур и линию на кадре
+                cv2.drawContours(frame, [largest_contour], -1, (0, 255, 0), 2)
+                cv2.line(frame, (center_x, 0), (center_x, frame.shape[0]), (255, 0, 0), 2)
 
-            if cv2.waitKey(wait_key) & 0xFF == ord('q'):  # 'q' для выхода
-                break
+        cv2.imshow(window_name, frame)
 
-        frame_count += 1
+        if cv2.waitKey(wait_key) & 0xFF == ord('q'):  # 'q' для выхода
+            break
 
     cap.release()
     cv2.destroyAllWindows()
 
 # проверяем что надпочечники на своих местах
-def display_video_with_center(video_path, frame_skip=5, wait_key=200):
+def display_video_with_center(video_path, frame_skip=5, wait_key=200, stats=None):
     """
     Функция проводит вертикальную линию через центр каждого {frame_skip} кадра для РУЧНОГО контроля того, что пациент не сместился. Выводит название файла.
+    stats (IngestStats) - необязательные замеры открытия и декодирования видео.
     """
 
     file_name = os.path.splitext(os.path.basename(video_path))[0]
 
 
-    cap = cv2.VideoCapture(video_path)
+    cap = open_video(video_path, stats)
     if not cap.isOpened():
         print(f"Не удалось открыть видеофайл: {video_path}")
         return
 
     window_name = 'Display_video'
-    frame_count = 0
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        if frame_count % frame_skip == 0:
-            height, width, _ = frame.shape
-
-            center_x = width // 2
-            cv2.line(frame, (center_x, 0), (center_x, height), (255, 0, 0), 2)
+    for _, frame in read_sampled_frames(cap, frame_skip, stats):
+        height, width, _ = frame.shape
 
-            # Выводим название файла на видео
-            cv2.putText(frame, file_name, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2, cv2.LINE_AA)
+        center_x = width // 2
+        cv2.line(frame, (center_x, 0), (center_x, height), (255, 0, 0), 2)
 
-            cv2.imshow(window_name, frame)
+        # Выводим название файла на видео
+        cv2.putText(frame, file_name, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2, cv2.LINE_AA)
 
-            if cv2.waitKey(wait_key) & 0xFF == ord('q'): # выход
-                break
+        cv2.imshow(window_name, frame)
 
-        frame_count += 1
+        if cv2.waitKey(wait_key) & 0xFF == ord('q'): # выход
+            break
 
     cap.release()
     cv2.destroyAllWindows()
-def manual_directory_check(videos_dir):
+
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+
+
+def manual_directory_check(videos_dir, qc_report_file=None):
     """
         Функция проверяет каждое видео из {videos_dir} с использованием display_video_with_center()
+        Если передан qc_report_file (CSV из midline_qc), показываются только видео, отмеченные как смещенные,
+        по путям из отчета - в том числе из вложенных папок videos_dir (например, data/left_adrenal/class_X_Y_Z).
     """
 
+    if qc_report_file is not None:
+        report = pd.read_csv(qc_report_file)
+        videos_root = os.path.abspath(videos_dir)
+        for video_path in report.loc[report['flagged'], 'video_path']:
+            if os.path.commonpath([videos_root, os.path.abspath(video_path)]) != videos_root:
+                continue
+            if os.path.isfile(video_path):
+                display_video_with_center(video_path)
+            else:
+                print(f"Видео из отчета не найдено: {video_path}")
+        return
+
     for file_name in os.listdir(videos_dir):
         video_path = os.path.join(videos_dir, file_name)
 
-        if os.path.isfile(video_path) and file_name.endswith(('.mp4', '.avi', '.mov', '.mkv')):
+        if os.path.isfile(video_path) and file_name.endswith(VIDEO_EXTENSIONS):
             display_video_with_center(video_path)
 
-# заполняем папку data
-def copy_videos_from_excel(excel_path, video_dir, data_dir):
+
+
+def body_centers(frames, threshold=40):
     """
-    Функция перемещает видео из папки video_dir в папку data, согласно Excel-файлу.
+    Находит горизонтальный центр тела пациента на каждом кадре сразу для всего массива кадров: пиксели ярче
+    threshold считаются телом, центр - среднее x-координат этих пикселей (центр масс маски).
 
     Параметры:
-        excel_path (str): Путь к Excel-файлу
-        video_dir (str): Путь к директории, в которой хранятся исходные видео.
-        data_dir (str): Путь к корневой папке, в которой будут создаваться директории для файлов.
+        frames (np.ndarray): Массив серых кадров формы (число кадров, высота, ширина).
 
     Возвращает:
-        list: Список файлов, которые не были найдены в video_dir.
+        np.ndarray: Центры по x для каждого кадра (float). NaN для кадров без тела.
     """
+    column_mass = (frames > threshold).sum(axis=1, dtype=np.int64)  # (число кадров, ширина)
+    total_mass = column_mass.sum(axis=1)
+    x = np.arange(frames.shape[2])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(total_mass > 0, column_mass @ x / total_mass, np.nan)
 
-    try:
-        df = pd.read_excel(excel_path)
-    except Exception as e:
-        print(f"Ошибка при чтении файла Excel: {e}")
-        return []
 
-    not_found_files = []
+def check_video_midline(video_path, frame_skip=5, threshold=40, offset_tolerance=0.05, drift_tolerance=0.03):
+    """
+    Автоматическая замена ручной проверки display_video_with_center: вычисляет центр тела на каждом {frame_skip}
+    кадре и проверяет, что пациент лежит по центру (width // 2) и не смещается по ходу серии.
 
-    # Проходим по каждой строке таблицы
-    for index, row in df.iterrows():
-        file_name = row['Файл c нативной фазой'] + '.mp4'  # Имя видео
-        target_subdir = row['Путь']
+    Параметры:
+        offset_tolerance (float): Допустимое смещение среднего центра тела от width // 2, в долях ширины кадра.
+        drift_tolerance (float): Допустимый разброс центра тела между кадрами (max - min), в долях ширины кадра.
 
+    Возвращает:
+        dict: Результат проверки (video_path, frames, width, mean_offset, max_offset, drift, flagged, reason).
+              Смещения и разброс - в долях ширины кадра.
+    """
+    result = {'video_path': video_path, 'frames': 0, 'width': 0, 'mean_offset': np.nan, 'max_offset': np.nan,
+              'drift': np.nan, 'flagged': True, 'reason': ''}
 
-        source_path = os.path.join(video_dir, file_name)
-        target_path = os.path.join(data_dir, target_subdir)
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        result['reason'] = 'не удалось открыть'
+        return result
 
+    frames = [cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for _, frame in read_sampled_frames(cap, frame_skip)]
+    cap.release()
+    if not frames:
+        result['reason'] = 'нет кадров'
+        return result
+
+    frames = np.stack(frames)
+    width = frames.shape[2]
+    centers = body_centers(frames, threshold)
+    centers = centers[~np.isnan(centers)]
+    result['frames'] = len(frames)
+    result['width'] = width
+    if len(centers) == 0:
+        result['reason'] = 'тело не найдено'
+        return result
+
+    offsets = (centers - width // 2) / width
+    result['mean_offset'] = float(offsets.mean())
+    result['max_offset'] = float(np.abs(offsets).max())
+    result['drift'] = float((centers.max() - centers.min()) / width)
+
+    reasons = []
+    if abs(result['mean_offset']) > offset_tolerance:
+        reasons.append('смещение от центра')
+    if result['drift'] > drift_tolerance:
+        reasons.append('смещение по ходу серии')
+    result['flagged'] = bool(reasons)
+    result['reason'] = ', '.join(reasons)
+
+    return result
+
+
+def midline_qc(videos_dir, report_file=None, frame_skip=5, threshold=40, offset_tolerance=0.05, drift_tolerance=0.03,
+               workers=None):
+    """
+    Проверяет все видео в videos_dir (включая вложенные папки, например, data/) без вывода на экран
+    (см. check_video_midline), параллельно в workers процессах, и сохраняет отчет в CSV.
+    Вручную нужно просмотреть только отмеченные видео: manual_directory_check(videos_dir, report_file).
 
-        if os.path.exists(source_path):
+    Возвращает:
+        pd.DataFrame: Отчет, по строке на видео.
+    """
+    video_paths = []
+    for root, _, file_names in os.walk(videos_dir):
+        for file_name in sorted(file_names):
+            if file_name.endswith(VIDEO_EXTENSIONS):
+                video_paths.append(os.path.join(root, file_name))
 
-            # Полный путь к новому местоположению видео
-            target_file_path = os.path.join(target_path, file_name)
+    task_args = [(video_path, frame_skip, threshold, offset_tolerance, drift_tolerance) for video_path in video_paths]
+    results = _map_tasks(check_video_midline, task_args, workers)
 
-            # Перемещаем файл, если его еще нет в целевой папке
-            if not os.path.exists(target_file_path):
-                try:
-                    shutil.copy2(source_path, target_file_path)
-                    print(f"Видео {file_name} успешно перемещено в {target_file_path}")
-                except Exception as e:
-                    print(f"Ошибка при перемещении {file_name}: {e}")
-            else:
-                print(f"Видео {file_name} уже находится в {target_file_path}")
-        else:
-            print(f"Видео {file_name} не найдено в {video_dir}")
-            not_found_files.append(file_name)
+    report = pd.DataFrame(results, columns=['video_path', 'frames', 'width', 'mean_offset', 'max_offset', 'drift',
+                                            'flagged', 'reason'])
+    if report_file is not None:
+        report.to_csv(report_file, index=False)
 
-    return not_found_files
+    print(f"Проверено видео: {len(report)}, отмечено для ручной проверки: {int(report['flagged'].sum())}")
 
-# функция для загрузки и обработки видео с уменьшением количества и размера кадров.
-def load_videos(data_dir, target_size=(224, 224), frame_skip=5, add_third_dimension=False):
+    return report
+
+def read_frames_at(cap, indices):
     """
-      Функция загружает видео из указанной директории, обрабатывает их (уменьшает количество кадров, уменьшает размер) и
-      сохраняет в виде массивов.
+    Читает из открытого cv2.VideoCapture кадры с заданными номерами. Остальные кадры только захватываются через
+    cap.grab() без retrieve (см. read_sampled_frames).
 
-      Возвращает:
-          videos : Массив обработанных видео.
-          labels : Массив меток классов. [0 0 1]
-          label_names : Список имен меток. 'left_001'
-      """
+    Возвращает:
+        list: Список кадров в порядке возрастания номеров (кадров может быть меньше, если видео короче).
+    """
+    wanted = set(int(i) for i in indices)
+    last = max(wanted, default=-1)
+    frames = []
+    frame_count = 0
+    while frame_count <= last and cap.grab():
+        if frame_count in wanted:
+            ret, frame = cap.retrieve()
+            if ret:
+                frames.append(frame)
+        frame_count += 1
 
-    videos = []
-    labels = []
-    formatted_label_names = []
-    label_names = os.listdir(data_dir)
+    return frames
 
-    for label_name in label_names:
-        label_dir = os.path.join(data_dir, label_name)
-        if 'left_adrenal' in label_name:
-            prefix = 'left'
-        elif 'right_adrenal' in label_name:
-            prefix = 'right'
-        else:
-            continue
 
+def make_contact_sheet(frames, title='', n_cols=4, tile_width=256, draw_center=True):
+    """
+    Собирает из кадров одно изображение-мозаику (contact sheet) для быстрого просмотра исследования.
+    На каждом кадре, как в display_video_with_center, проводится вертикальная линия через центр кадра,
+    сверху выводится название.
 
-        class_names = os.listdir(label_dir)
-        for class_name in class_names:
-            class_path = os.path.join(label_dir, class_name)
-            for video_name in os.listdir(class_path):
-                video_path = os.path.join(class_path, video_name)
-                cap = cv2.VideoCapture(video_path)
-                frames = []
-                frame_count = 0
-                while cap.isOpened():
-                    ret, frame = cap.read()
-                    if not ret:
-                        break
-
-                    if frame_count % frame_skip == 0:
-                        # Обрезаем изображение в зависимости от надпочечника
-                        if prefix == 'left':
-                            frame = frame[:, :frame.shape[1] // 2]
-                        else:
-                            frame = frame[:, frame.shape[1] // 2:]
-
-
-                        frame = cv2.cvtColor(cv2.resize(frame, target_size), cv2.COLOR_BGR2GRAY)
-                        if add_third_dimension:
-                            frame = np.expand_dims(frame, axis=-1)  # Добавление канала для совместимости формы для некоторых моделей
-
-                        frames.append(frame)
-                    frame_count += 1
-                cap.release()
+    Параметры:
+        frames: Кадры - BGR (высота, ширина, 3) или серые (высота, ширина[, 1]).
+        n_cols (int): Число кадров в строке мозаики.
+        tile_width (int): Ширина одного кадра в мозаике (высота - с сохранением пропорций).
 
-                # Генерируем метку в виде массива из трех чисел
-                class_parts = class_name.split('_')[1:]
-                label = [np.uint8(int(class_parts[i])) for i in range(3)]
+    Возвращает:
+        np.ndarray: BGR-изображение мозаики.
+    """
+    tiles = []
+    for frame in frames:
+        frame = np.asarray(frame)
+        if frame.ndim == 3 and frame.shape[2] == 1:
+            frame = frame[:, :, 0]
+        if frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+        height, width = frame.shape[:2]
+        tile = cv2.resize(frame, (tile_width, max(int(round(height * tile_width / width)), 1)))
+        if draw_center:
+            center_x = tile_width // 2
+            cv2.line(tile, (center_x, 0), (center_x, tile.shape[0]), (255, 0, 0), 1)
+        tiles.append(tile)
+
+    title_height = 40
+    if not tiles:
+        sheet = np.zeros((title_height, tile_width * n_cols, 3), dtype=np.uint8)
+    else:
+        tile_height = tiles[0].shape[0]
+        n_rows = (len(tiles) + n_cols - 1) // n_cols
+        sheet = np.zeros((title_height + n_rows * tile_height, n_cols * tile_width, 3), dtype=np.uint8)
+        for i, tile in enumerate(tiles):
+            row, col = divmod(i, n_cols)
+            y = title_height + row * tile_height
+            sheet[y:y + tile.shape[0], col * tile_width:(col + 1) * tile_width] = tile[:tile_height]
+
+    cv2.putText(sheet, title, (10, 28), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2, cv2.LINE_AA)
+
+    return sheet
+
+
+def evenly_spaced_indices(total, n_frames):
+    # Номера n_frames кадров, равномерно распределенных по видео из total кадров
+    if total <= 0:
+        return np.array([], dtype=np.int64)
+    return np.unique(np.linspace(0, total - 1, min(n_frames, total)).round().astype(np.int64))
+
+
+def video_contact_sheet(video_path, output_file=None, n_frames=16, n_cols=4, tile_width=256):
+    """
+    Создает мозаику из n_frames равномерно распределенных кадров видео (см. make_contact_sheet) с названием файла.
+    Если задан output_file, сохраняет ее в PNG.
 
-                # Генерируем имя метки в виде left_001 или right_001
-                formatted_label_name = f"{prefix}_{''.join(class_parts)}"
+    Возвращает:
+        np.ndarray: BGR-изображение мозаики или None, если видео не открылось.
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Не удалось открыть видеофайл: {video_path}")
+        return None
 
-                videos.append(np.array(frames, dtype=np.uint8))
-                labels.append(label)
-                formatted_label_names.append(formatted_label_name)
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frames = read_frames_at(cap, evenly_spaced_indices(total, n_frames))
+    cap.release()
 
-    return np.array(videos, dtype=np.uint8), np.array(labels, dtype=np.int64), formatted_label_names
+    file_name = os.path.splitext(os.path.basename(video_path))[0]
+    sheet = make_contact_sheet(frames, file_name, n_cols, tile_width)
+    if output_file is not None:
+        cv2.imwrite(output_file, sheet)
 
+    return sheet
 
 
+def tensor_contact_sheet(video, title='', output_file=None, n_frames=16, n_cols=4, tile_width=256):
+    """
+    Создает мозаику для обработанного видео из load_videos (массив формы (число кадров, высота, ширина[, 1])).
+    Если задан output_file, сохраняет ее в PNG.
 
-if __name__ == "__main__":
-    # create_folder_structure(r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture')
-    # test_download_and_display_single_video(r"C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\База данных МСКТ надпочечников_MP4.xlsx", column_names=['Файл c нативной фазой'])
+    Возвращает:
+        np.ndarray: BGR-изображение мозаики.
+    """
+    frames = [video[i] for i in evenly_spaced_indices(len(video), n_frames)]
+    sheet = make_contact_sheet(frames, title, n_cols, tile_width)
+    if output_file is not None:
+        cv2.imwrite(output_file, sheet)
 
-    video_path = r"C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\data\class02\ID5_NATIVE_SE1.mp4"
-    # display_video(video_path,frame_skip=5, wait_key=200)
-    # display_video_with_max_contour(video_path, frame_skip=5, wait_key=500) # не работает пока
-    # display_video_with_center(video_path, frame_skip=5)
+    return sheet
 
-    data_dir = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture\data'
-    # videos, labels, label_names = load_videos(data_dir, target_size=(224, 224), frame_skip=5, add_third_dimension=True)
-    # print(labels, label_names)
 
+def _save_video_contact_sheet(video_path, output_file, n_frames, n_cols, tile_width):
+    # Мозаика не возвращается в основной процесс, только сохраняется
+    return video_contact_sheet(video_path, output_file, n_frames, n_cols, tile_width) is not None
 
-    image_dir = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Все картинки'  # Путь к папке с картинками
-    excel_file = r"C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\База данных МСКТ надпочечников_MP4.xlsx"  # Путь к Excel-файлу
 
-    # missing_images = check_images_in_excel(image_dir, excel_file)
-    # # Печать картинок, которых нет в Excel
-    # print("Картинки, не найденные в Excel:", missing_images)
+def contact_sheets_for_directory(videos_dir, output_dir, n_frames=16, n_cols=4, tile_width=256, workers=None):
+    """
+    Создает PNG-мозаики для всех видео в videos_dir (включая вложенные папки) параллельно в workers процессах.
+    Структура вложенных папок повторяется в output_dir, так что всю папку класса можно просмотреть в программе
+    просмотра изображений.
 
+    Возвращает:
+        list: Пути к созданным PNG-файлам.
+    """
+    task_args = []
+    for root, _, file_names in os.walk(videos_dir):
+        target_dir = os.path.join(output_dir, os.path.relpath(root, videos_dir))
+        for file_name in sorted(file_names):
+            if file_name.endswith(VIDEO_EXTENSIONS):
+                os.makedirs(target_dir, exist_ok=True)
+                output_file = os.path.join(target_dir, os.path.splitext(file_name)[0] + '.png')
+                task_args.append((os.path.join(root, file_name), output_file, n_frames, n_cols, tile_width))
 
-    # проверял смещение
-    # image_dir = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Все картинки'
-    # manual_directory_check(image_dir)
+    created = _map_tasks(_save_video_contact_sheet, task_args, workers)
 
+    output_files = [args[1] for args, ok in zip(task_args, created) if ok]
+    print(f"Создано мозаик: {len(output_files)} в {output_dir}")
 
+    return output_files
 
-    # data_dir = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture\data'
-    # videos, labels, labels_names = load_videos(data_dir)
+
+def transfer_video(source_path, target_file_path, link_mode='copy'):
+    """
+    Переносит одно видео в целевую папку.
+
+    Параметры:
+        link_mode (str): 'copy' - копирование (shutil.copy2), 'hardlink' - жесткая ссылка, 'symlink' - символическая
+                         ссылка. Если ссылку создать не удалось (например, другая файловая система), файл копируется.
+    """
+    if link_mode == 'hardlink':
+        try:
+            os.link(source_path, target_file_path)
+            return
+        except OSError:
+            pass
+    elif link_mode == 'symlink':
+        try:
+            os.symlink(os.path.abspath(source_path), target_file_path)
+            return
+        except OSError:
+            pass
+
+    shutil.copy2(source_path, target_file_path)
+
+
+def read_copy_manifest(manifest_file):
+    """
+    Читает манифест copy_videos_from_excel: по одному пути уже перенесенного файла на строку.
+
+    Возвращает:
+        set: Множество путей, которые уже были перенесены.
+    """
+    if manifest_file is None or not os.path.isfile(manifest_file):
+        return set()
+
+    with open(manifest_file, encoding='utf-8') as f:
+        return {line.rstrip('\n') for line in f if line.strip()}
+
+
+# заполняем папку data
+def copy_videos_from_excel(excel_path, video_dir, data_dir, workers=None, link_mode='copy', manifest_file=None):
+    """
+    Функция перемещает видео из папки video_dir в папку data, согласно Excel-файлу.
+
+    Параметры:
+        excel_path (str): Путь к Excel-файлу
+        video_dir (str): Путь к директории, в которой хранятся исходные видео.
+        data_dir (str): Путь к корневой папке, в которой будут создаваться директории для файлов.
+        workers (int): Число потоков для параллельного копирования. None или 1 - по одному файлу.
+        link_mode (str): 'copy', 'hardlink' или 'symlink' (см. transfer_video).
+        manifest_file (str): Путь к файлу-манифесту. Каждый перенесенный файл дописывается в манифест, поэтому
+                             прерванный запуск продолжается с того места, где остановился. Файл в целевой папке,
+                             которого нет в манифесте и размер которого отличается от исходного, считается
+                             недокопированным и переносится заново, как и файл из манифеста, которого уже нет
+                             в целевой папке.
+
+    Возвращает:
+        list: Список файлов, которые не были найдены в video_dir.
+    """
+
+    try:
+        df = pd.read_excel(excel_path)
+    except Exception as e:
+        print(f"Ошибка при чтении файла Excel: {e}")
+        return []
+
+    not_found_files = []
+
+    # Содержимое папок читается один раз вместо os.path.exists для каждого файла
+    source_files = set(os.listdir(video_dir)) if os.path.isdir(video_dir) else set()
+    target_files = {}
+    done = read_copy_manifest(manifest_file)
+    pending_manifest = []
+
+    # Собираем список файлов для переноса, проходя по каждой строке таблицы
+    transfers = []
+    for file_name, target_subdir in zip(df['Файл c нативной фазой'], df['Путь']):
+        file_name = file_name + '.mp4'  # Имя видео
+
+        source_path = os.path.join(video_dir, file_name)
+        target_path = os.path.join(data_dir, target_subdir)
+
+
+        if file_name in source_files:
+
+            # Полный путь к новому местоположению видео
+            target_file_path = os.path.join(target_path, file_name)
+
+            if target_path not in target_files:
+                target_files[target_path] = set(os.listdir(target_path)) if os.path.isdir(target_path) else set()
+
+            # Файл из манифеста переносится заново, если его уже нет в целевой папке
+            already_copied = file_name in target_files[target_path]
+            if already_copied and not os.path.exists(target_file_path):
+                # Битая символическая ссылка (link_mode='symlink', исходный файл перемещен) - переносим заново
+                os.remove(target_file_path)
+                already_copied = False
+            if manifest_file is not None and target_file_path not in done and already_copied:
+                # Файла нет в манифесте: это может быть недокопированный файл прерванного запуска
+                if os.path.getsize(target_file_path) == os.path.getsize(source_path):
+                    pending_manifest.append(target_file_path)
+                else:
+                    os.remove(target_file_path)
+                    already_copied = False
+
+            # Перемещаем файл, если его еще нет в целевой папке
+            if not already_copied:
+                target_files[target_path].add(file_name)
+                transfers.append((file_name, source_path, target_file_path))
+            else:
+                print(f"Видео {file_name} уже находится в {target_file_path}")
+        else:
+            print(f"Видео {file_name} не найдено в {video_dir}")
+            not_found_files.append(file_name)
+
+    manifest = open(manifest_file, 'a', encoding='utf-8') if manifest_file is not None else None
+    manifest_lock = threading.Lock()
+    if manifest is not None and pending_manifest:
+        manifest.write(''.join(path + '\n' for path in pending_manifest))
+        manifest.flush()
+
+    def transfer(item):
+        file_name, source_path, target_file_path = item
+        try:
+            transfer_video(source_path, target_file_path, link_mode)
+            print(f"Видео {file_name} успешно перемещено в {target_file_path}")
+        except Exception as e:
+            print(f"Ошибка при перемещении {file_name}: {e}")
+            return
+
+        if manifest is not None:
+            with manifest_lock:
+                manifest.write(target_file_path + '\n')
+                manifest.flush()
+
+    try:
+        if workers is not None and workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(transfer, transfers))
+        else:
+            for item in transfers:
+                transfer(item)
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+    return not_found_files
+
+def collect_video_tasks(data_dir, duplicates_report=None):
+    """
+    Обходит директорию data_dir (left_adrenal/right_adrenal -> class_X_Y_Z -> видео) и собирает список видео
+    в том же порядке, в котором их обрабатывает load_videos.
+
+    Параметры:
+        duplicates_report: Отчет find_duplicate_videos (путь к CSV или pd.DataFrame). Если задан, видео,
+                           отмеченные в нем как дубликаты (duplicate = True), пропускаются.
+
+    Возвращает:
+        list: Список кортежей (video_path, prefix, class_name), где prefix - 'left' или 'right'.
+    """
+    skipped = set()
+    if duplicates_report is not None:
+        report = pd.read_csv(duplicates_report) if isinstance(duplicates_report, str) else duplicates_report
+        skipped = {os.path.abspath(video_path) for video_path in report.loc[report['duplicate'], 'video_path']}
+
+    tasks = []
+    for label_name in os.listdir(data_dir):
+        label_dir = os.path.join(data_dir, label_name)
+        if 'left_adrenal' in label_name:
+            prefix = 'left'
+        elif 'right_adrenal' in label_name:
+            prefix = 'right'
+        else:
+            continue
+
+        for class_name in os.listdir(label_dir):
+            class_path = os.path.join(label_dir, class_name)
+            for video_name in os.listdir(class_path):
+                video_path = os.path.join(class_path, video_name)
+                if os.path.abspath(video_path) in skipped:
+                    continue
+                tasks.append((video_path, prefix, class_name))
+
+    if skipped:
+        print(f"Пропущено дубликатов: {len(skipped)}")
+
+    return tasks
+
+
+# Размер перцептивного хэша кадра: кадр уменьшается до (DHASH_SIZE + 1) x DHASH_SIZE, хэш - DHASH_SIZE ** 2 бит
+DHASH_SIZE = 16
+# На сколько уровней серого левый пиксель должен быть ярче правого, чтобы бит хэша был 1. Без запаса биты
+# однородных областей (фон, мягкие ткани) случайно меняются от шума и перекодирования
+DHASH_MARGIN = 2
+
+
+def frame_dhash(frame, prefix=None):
+    """
+    Перцептивный хэш кадра (dHash): половина кадра (prefix = 'left' или 'right', None - весь кадр) переводится
+    в серый, уменьшается до (DHASH_SIZE + 1) x DHASH_SIZE, и для каждой пары соседних по горизонтали пикселей
+    записывается бит "левый ярче правого больше чем на DHASH_MARGIN". Хэш почти не меняется при перекодировании
+    и изменении размера видео.
+
+    Возвращает:
+        np.ndarray: DHASH_SIZE ** 2 бит, упакованных в uint8.
+    """
+    if prefix == 'left':
+        frame = frame[:, :frame.shape[1] // 2]
+    elif prefix == 'right':
+        frame = frame[:, frame.shape[1] // 2:]
+
+    small = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (DHASH_SIZE + 1, DHASH_SIZE),
+                       interpolation=cv2.INTER_AREA).astype(np.int16)
+    return np.packbits(small[:, :-1] - small[:, 1:] > DHASH_MARGIN)
+
+
+def video_perceptual_hash(video_path, prefix=None, n_frames=8):
+    """
+    Перцептивный хэш исследования: хэши frame_dhash n_frames равномерно распределенных кадров, записанные подряд.
+    Декодируются только эти кадры (см. read_frames_at). Если кадров в видео меньше n_frames, хэш дополняется нулями.
+    Если контейнер не сообщает число кадров, кадры пересчитываются через cap.grab() (см. probe_video_frame_count).
+
+    Возвращает:
+        np.ndarray: n_frames * DHASH_SIZE ** 2 бит, упакованных в uint8, или None, если видео не открылось
+                    или не прочитано ни одного кадра (иначе нулевые хэши таких видео совпали бы между собой).
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Не удалось открыть видеофайл: {video_path}")
+        return None
+
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    if total <= 0:
+        total = probe_video_frame_count(video_path, 1)
+    frames = read_frames_at(cap, evenly_spaced_indices(total, n_frames))
+    cap.release()
+    if not frames:
+        print(f"Не удалось прочитать кадры видео: {video_path}")
+        return None
+
+    study_hash = np.zeros(n_frames * DHASH_SIZE ** 2 // 8, dtype=np.uint8)
+    frame_hashes = np.concatenate([frame_dhash(frame, prefix) for frame in frames])
+    study_hash[:len(frame_hashes)] = frame_hashes
+
+    return study_hash
+
+
+class HammingIndex:
+    """
+    Индекс бинарных хэшей для поиска близких по расстоянию Хэмминга (числу различающихся бит).
+    Хэш делится на max_distance + 1 полос: если хэши различаются не больше чем в max_distance битах, хотя бы одна
+    полоса у них совпадает целиком. Поэтому кандидаты берутся из словарей полос, а точное расстояние считается
+    только для них, и совпадения не пропускаются.
+
+    Параметры:
+        n_bits (int): Длина хэша в битах.
+        max_distance (int): Наибольшее расстояние, при котором хэши считаются совпадающими.
+    """
+
+    def __init__(self, n_bits, max_distance):
+        self.max_distance = max_distance
+        bounds = np.linspace(0, n_bits, min(max_distance + 1, n_bits) + 1).round().astype(np.int64)
+        self.bands = list(zip(bounds[:-1], bounds[1:]))
+        self.tables = [{} for _ in self.bands]
+        self.bits = []
+
+    def __len__(self):
+        return len(self.bits)
+
+    def query(self, packed_hash):
+        """
+        Возвращает:
+            list: Пары (номер хэша в индексе, расстояние) для хэшей на расстоянии не больше max_distance.
+        """
+        bits = np.unpackbits(packed_hash)
+        candidates = set()
+        for (start, stop), table in zip(self.bands, self.tables):
+            candidates.update(table.get(bits[start:stop].tobytes(), ()))
+
+        matches = []
+        for candidate in sorted(candidates):
+            distance = int(np.count_nonzero(self.bits[candidate] != bits))
+            if distance <= self.max_distance:
+                matches.append((candidate, distance))
+        return matches
+
+    def add(self, packed_hash):
+        # Добавляет хэш и возвращает его номер в индексе
+        bits = np.unpackbits(packed_hash)
+        number = len(self.bits)
+        for (start, stop), table in zip(self.bands, self.tables):
+            table.setdefault(bits[start:stop].tobytes(), []).append(number)
+        self.bits.append(bits)
+        return number
+
+
+def find_duplicate_videos(data_dir, report_file=None, n_frames=8, max_distance=20, workers=None):
+    """
+    Ищет повторяющиеся исследования в data_dir до запуска load_videos: одну и ту же серию в нескольких папках
+    классов или под разными именами. Для каждого видео считается перцептивный хэш той половины кадра, которая
+    пойдет в обработку (см. video_perceptual_hash), параллельно в workers процессах; близкие хэши ищутся
+    через HammingIndex отдельно для left и right, поэтому одно исследование в left_adrenal и right_adrenal
+    дубликатом не считается.
+
+    Параметры:
+        n_frames (int): Число кадров в хэше исследования.
+        max_distance (int): Наибольшее число различающихся бит (из n_frames * DHASH_SIZE ** 2), при котором видео
+                            считаются дубликатами.
+        report_file (str): Путь к CSV-отчету. Отчет передается в load_videos(duplicates_report=...), чтобы
+                           пропустить дубликаты при загрузке.
+
+    Возвращает:
+        pd.DataFrame: По строке на каждое видео из групп дубликатов: group, video_path, prefix, class_name,
+                      distance (до первого видео группы), duplicate (False у первого видео группы, оно остается
+                      при загрузке), class_conflict (видео группы лежат в разных классах). В группах с class_conflict
+                      duplicate=False у всех видео: какая метка верна, решается вручную, а не порядком обхода папок.
+    """
+    tasks = collect_video_tasks(data_dir)
+    task_args = [(video_path, prefix, n_frames) for video_path, prefix, _ in tasks]
+    hashes = _map_tasks(video_perceptual_hash, task_args, workers)
+
+    # Группы дубликатов: объединение найденных пар (у каждой группы корень - первое видео в порядке tasks)
+    parent = list(range(len(tasks)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    indices = {}
+    index_tasks = {}
+    for task_index, ((_, prefix, _), study_hash) in enumerate(zip(tasks, hashes)):
+        if study_hash is None:
+            continue
+        if prefix not in indices:
+            indices[prefix] = HammingIndex(len(study_hash) * 8, max_distance)
+            index_tasks[prefix] = []
+        for number, _ in indices[prefix].query(study_hash):
+            root, other = sorted((find(task_index), find(index_tasks[prefix][number])))
+            parent[other] = root
+        indices[prefix].add(study_hash)
+        index_tasks[prefix].append(task_index)
+
+    groups = {}
+    for task_index in range(len(tasks)):
+        groups.setdefault(find(task_index), []).append(task_index)
+
+    rows = []
+    for group_number, members in enumerate(members for members in groups.values() if len(members) > 1):
+        first = members[0]
+        class_conflict = len({tasks[i][2] for i in members}) > 1
+        for i in members:
+            video_path, prefix, class_name = tasks[i]
+            rows.append({'group': group_number, 'video_path': video_path, 'prefix': prefix, 'class_name': class_name,
+                         'distance': int(np.count_nonzero(np.unpackbits(hashes[i] ^ hashes[first]))),
+                         'duplicate': i != first and not class_conflict, 'class_conflict': class_conflict})
+
+    report = pd.DataFrame(rows, columns=['group', 'video_path', 'prefix', 'class_name', 'distance', 'duplicate',
+                                         'class_conflict'])
+    if report_file is not None:
+        report.to_csv(report_file, index=False)
+
+    n_groups = report['group'].nunique()
+    print(f"Проверено видео: {len(tasks)}, групп дубликатов: {n_groups}, из них в разных классах: "
+          f"{report.loc[report['class_conflict'], 'group'].nunique()}, лишних видео: {int(report['duplicate'].sum())}")
+
+    return report
+
+
+def _fit_interval(start, length, new_length, limit):
+    # Отрезок длины new_length с тем же центром, что [start, start + length), сдвинутый внутрь [0, limit)
+    new_length = min(new_length, limit)
+    new_start = int(round(start + length / 2 - new_length / 2))
+    return min(max(new_start, 0), limit - new_length), new_length
+
+
+def estimate_body_roi(video_path, prefix, target_size=(224, 224), n_frames=8, threshold=40, margin=0.05,
+                      min_area=0.01):
+    """
+    Оценивает один раз на исследование прямоугольник тела пациента в половине кадра prefix ('left' или 'right'),
+    чтобы при загрузке обрезать черный фон до resize (см. transform_frame). Берутся n_frames равномерно
+    распределенных кадров (декодируются только они; если контейнер не сообщает число кадров, кадры пересчитываются
+    через cap.grab(), см. probe_video_frame_count), по их поэлементному максимуму строится маска тела
+    (яркость больше threshold, как в body_centers) и выбирается самый большой контур. Прямоугольник расширяется
+    на margin с каждой стороны и до соотношения сторон target_size (насколько позволяет половина кадра), чтобы
+    resize не искажал пропорции.
+    Если тело не найдено (контур меньше min_area половины кадра), возвращается вся половина кадра.
+
+    Возвращает:
+        tuple: (x, y, ширина, высота) в координатах всего кадра или None, если видео не открылось.
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Не удалось открыть видеофайл: {video_path}")
+        return None
+
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    if total <= 0:
+        total = probe_video_frame_count(video_path, 1)
+    frames = read_frames_at(cap, evenly_spaced_indices(total, n_frames))
+    cap.release()
+    if not frames:
+        return None
+
+    height, width = frames[0].shape[:2]
+    half_x, half_width = (0, width // 2) if prefix == 'left' else (width // 2, width - width // 2)
+    half_roi = (half_x, 0, half_width, height)
+
+    projection = np.max([cv2.cvtColor(frame[:, half_x:half_x + half_width], cv2.COLOR_BGR2GRAY)
+                         for frame in frames], axis=0)
+    contours, _ = cv2.findContours((projection > threshold).astype(np.uint8), cv2.RETR_EXTERNAL,
+                                   cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return half_roi
+    body = max(contours, key=cv2.contourArea)
+    if cv2.contourArea(body) < min_area * half_width * height:
+        return half_roi
+
+    x, y, w, h = cv2.boundingRect(body)
+    x0, y0 = max(x - int(round(w * margin)), 0), max(y - int(round(h * margin)), 0)
+    x1, y1 = min(x + w + int(round(w * margin)), half_width), min(y + h + int(round(h * margin)), height)
+    x, w = x0, x1 - x0
+    y, h = y0, y1 - y0
+
+    aspect = target_size[0] / target_size[1]
+    if w < h * aspect:
+        x, w = _fit_interval(x, w, int(round(h * aspect)), half_width)
+    else:
+        y, h = _fit_interval(y, h, int(round(w / aspect)), height)
+
+    return half_x + x, y, w, h
+
+
+# Версия оценки области тела. Увеличивается при изменении estimate_body_roi, чтобы старый кэш областей не использовался
+ROI_VERSION = 1
+
+
+def body_rois_cache_path(cache_dir, target_size=(224, 224), n_frames=8, threshold=40, margin=0.05):
+    # JSON-файл кэша областей тела для данных параметров estimate_body_roi: {ключ видео: [x, y, ширина, высота]}
+    return os.path.join(cache_dir, f"rois_v{ROI_VERSION}_{target_size[0]}x{target_size[1]}_n{n_frames}_"
+                                   f"t{threshold}_m{margin}.json")
+
+
+def estimate_body_rois(tasks, target_size=(224, 224), n_frames=8, threshold=40, margin=0.05, workers=None,
+                       cache_dir=None):
+    """
+    Оценивает область тела (см. estimate_body_roi) для каждого видео из collect_video_tasks параллельно в workers
+    процессах. Результат передается в load_videos(rois=...) и save_metadata_index(rois=...).
+    Если задан cache_dir, области хранятся в JSON-файле в cache_dir (см. body_rois_cache_path) с тем же ключом
+    идентичности файла, что и кэш кадров (см. video_file_key): оцениваются только новые или измененные видео,
+    записи удаленных видео удаляются.
+
+    Возвращает:
+        list: Для каждого видео в порядке tasks - (x, y, ширина, высота) или None.
+    """
+    if cache_dir is None:
+        task_args = [(video_path, prefix, target_size, n_frames, threshold, margin) for video_path, prefix, _ in tasks]
+        return _map_tasks(estimate_body_roi, task_args, workers)
+
+    cache_file = body_rois_cache_path(cache_dir, target_size, n_frames, threshold, margin)
+    cached = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file, encoding='utf-8') as f:
+            cached = json.load(f)
+
+    keys = [video_file_key(video_path, prefix) for video_path, prefix, _ in tasks]
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+    task_args = [(tasks[i][0], tasks[i][1], target_size, n_frames, threshold, margin) for i in missing]
+    for i, roi in zip(missing, _map_tasks(estimate_body_roi, task_args, workers)):
+        if roi is not None:
+            cached[keys[i]] = [int(value) for value in roi]
+    print(f"Кэш областей тела {cache_file}: из кэша {len(tasks) - len(missing)}, оценено {len(missing)}")
+
+    # В кэше остаются только текущие видео
+    entries = {key: cached[key] for key in keys if key in cached}
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(entries, f)
+    os.replace(tmp_file, cache_file)
+
+    return [tuple(entries[key]) if key in entries else None for key in keys]
+
+
+# Во сколько раз (по площади) половина кадра может быть больше target_size, чтобы в transform_frame перевод в серый
+# делался до resize
+GRAY_FIRST_MAX_SCALE = 4
+
+
+def transform_frame(frame, prefix, target_size=(224, 224), add_third_dimension=False, out=None, stats=None):
+    """
+    Обрабатывает один BGR-кадр: обрезает половину кадра в зависимости от надпочечника (prefix = 'left' или 'right')
+    или область тела (prefix = (x, y, ширина, высота), см. estimate_body_roi),
+    переводит в оттенки серого и приводит размер к target_size. Если половина кадра не намного больше target_size,
+    перевод в серый делается до resize, чтобы масштабировать один канал вместо трех. При сильном уменьшении
+    (больше чем в GRAY_FIRST_MAX_SCALE раз по площади) дешевле сначала уменьшить кадр, и порядок остается прежним.
+
+    Параметры:
+        out (np.ndarray): Заранее выделенный массив формы (высота, ширина[, 1]), в который записывается результат
+                          (например, строка np.memmap). None - выделяется новый массив.
+        stats (IngestStats): Если передан, считается время этапов crop, gray, resize.
+
+    Возвращает:
+        np.ndarray: Обработанный кадр (uint8).
+    """
+    stats = stats if stats is not None else NULL_INGEST_STATS
+
+    # Обрезаем изображение в зависимости от надпочечника
+    with stats.timer('crop'):
+        if prefix == 'left':
+            frame = frame[:, :frame.shape[1] // 2]
+        elif prefix == 'right':
+            frame = frame[:, frame.shape[1] // 2:]
+        else:
+            x, y, width, height = prefix
+            frame = frame[y:y + height, x:x + width]
+
+    dst = out.reshape(out.shape[:2]) if out is not None else None
+    if frame.shape[0] * frame.shape[1] <= GRAY_FIRST_MAX_SCALE * target_size[0] * target_size[1]:
+        with stats.timer('gray'):
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        with stats.timer('resize'):
+            frame = cv2.resize(frame, target_size, dst=dst)
+    else:
+        with stats.timer('resize'):
+            frame = cv2.resize(frame, target_size)
+        with stats.timer('gray'):
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=dst)
+
+    if out is not None:
+        frame = out
+    elif add_third_dimension:
+        frame = np.expand_dims(frame, axis=-1)  # Добавление канала для совместимости формы для некоторых моделей
+
+    stats.count('bytes_produced', frame.nbytes)
+    return frame
+
+
+def is_multi_size(target_size):
+    # target_size задан списком размеров [(ширина, высота), ...], а не одним размером
+    return len(target_size) > 0 and isinstance(target_size[0], (tuple, list))
+
+
+def transform_frame_sizes(frame, prefix, target_sizes, add_third_dimension=False, outs=None, stats=None):
+    """
+    Обрабатывает один BGR-кадр сразу для нескольких размеров target_sizes. Самый большой размер получается
+    из кадра через transform_frame, каждый следующий (меньший) - уменьшением предыдущего результата (каскад),
+    поэтому дополнительный размер стоит одного resize небольшого серого кадра.
+
+    Параметры:
+        outs (list): Заранее выделенные массивы для каждого размера (см. transform_frame) или None.
+
+    Возвращает:
+        list: Обработанные кадры (uint8) в порядке target_sizes.
+    """
+    stats = stats if stats is not None else NULL_INGEST_STATS
+    order = sorted(range(len(target_sizes)), key=lambda i: target_sizes[i][0] * target_sizes[i][1], reverse=True)
+    results = [None] * len(target_sizes)
+
+    largest = order[0]
+    previous = transform_frame(frame, prefix, target_sizes[largest], add_third_dimension,
+                               out=outs[largest] if outs is not None else None, stats=stats)
+    results[largest] = previous
+
+    for i in order[1:]:
+        dst = outs[i].reshape(outs[i].shape[:2]) if outs is not None else None
+        with stats.timer('resize'):
+            resized = cv2.resize(previous.reshape(previous.shape[:2]), tuple(target_sizes[i]), dst=dst)
+        if outs is not None:
+            resized = outs[i]
+        elif add_third_dimension:
+            resized = np.expand_dims(resized, axis=-1)
+        stats.count('bytes_produced', resized.nbytes)
+        results[i] = previous = resized
+
+    return results
+
+
+def iter_processed_frames(video_path, prefix, target_size=(224, 224), frame_skip=5, add_third_dimension=False,
+                          stats=None):
+    """
+    Генератор, который декодирует одно видео и обрабатывает каждый {frame_skip} кадр (см. transform_frame).
+
+    Возвращает (yield):
+        np.ndarray: Обработанный кадр (uint8).
+    """
+    cap = open_video(video_path, stats)
+    try:
+        for _, frame in read_sampled_frames(cap, frame_skip, stats):
+            yield transform_frame(frame, prefix, target_size, add_third_dimension, stats=stats)
+    finally:
+        cap.release()
+
+
+# Версия обработки кадров. Увеличивается при изменении transform_frame, чтобы старые записи кэша не использовались
+PREPROCESSING_VERSION = 2
+
+
+def video_cache_params_key(target_size=(224, 224), frame_skip=5, add_third_dimension=False, cascade_from=None):
+    """
+    Ключ параметров предобработки для кэша: видео, обработанные с разными параметрами или другой версией
+    предобработки (PREPROCESSING_VERSION), хранятся в разных подпапках cache_dir.
+    cascade_from - размер, из которого кадры получены каскадным уменьшением (см. transform_frame_sizes): такие
+    кадры немного отличаются от уменьшенных напрямую и хранятся отдельно.
+    """
+    key = (f"v{PREPROCESSING_VERSION}_{target_size[0]}x{target_size[1]}_skip{frame_skip}_"
+           f"{'3d' if add_third_dimension else '2d'}")
+    if cascade_from is not None:
+        key += f"_from{cascade_from[0]}x{cascade_from[1]}"
+    return key
+
+
+def cascade_source(target_sizes, target_size):
+    # Размер, из которого каскадом получается target_size (самый большой из target_sizes), или None для него самого
+    largest = max(target_sizes, key=lambda size: size[0] * size[1])
+    return None if tuple(target_size) == tuple(largest) else tuple(largest)
+
+
+def video_cache_path(cache_dir, video_path, prefix, target_size=(224, 224), frame_skip=5, add_third_dimension=False,
+                     cascade_from=None):
+    """
+    Путь к кэшированному результату process_video. Имя файла - хэш от идентичности исходного файла
+    (абсолютный путь, размер, время изменения) и стороны обрезки, поэтому измененное или перемещенное видео
+    получает новый ключ.
+    """
+    params_key = video_cache_params_key(target_size, frame_skip, add_third_dimension, cascade_from)
+    return os.path.join(cache_dir, params_key, f"{video_file_key(video_path, prefix)}.npy")
+
+
+def video_file_key(video_path, prefix):
+    # Хэш идентичности исходного файла (абсолютный путь, размер, время изменения) и стороны обрезки
+    stat = os.stat(video_path)
+    identity = f"{os.path.abspath(video_path)}|{stat.st_size}|{stat.st_mtime_ns}|{prefix}"
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+
+def process_video(video_path, prefix, target_size=(224, 224), frame_skip=5, add_third_dimension=False,
+                  cache_dir=None, stats=None):
+    """
+    Декодирует и обрабатывает одно видео (см. iter_processed_frames).
+    Если задан cache_dir, результат берется из кэша, а при промахе - сохраняется в кэш (см. video_cache_path).
+    Если передан stats (IngestStats), для видео записываются время этапов и счетчики.
+
+    Возвращает:
+        np.ndarray: Массив кадров видео (uint8).
+    """
+    if cache_dir is not None:
+        cache_path = video_cache_path(cache_dir, video_path, prefix, target_size, frame_skip, add_third_dimension)
+        if os.path.isfile(cache_path):
+            if stats is None:
+                return np.load(cache_path)
+            stats.start_video(video_path)
+            start = time.perf_counter()
+            frames = np.load(cache_path)
+            stats.add_time('cache', time.perf_counter() - start)
+            stats.count('frames_kept', len(frames))
+            stats.count('bytes_produced', frames.nbytes)
+            return frames
+
+    frames = list(iter_processed_frames(video_path, prefix, target_size, frame_skip, add_third_dimension, stats))
+    start = time.perf_counter()
+    frames = np.array(frames, dtype=np.uint8)
+    if stats is not None:
+        stats.add_time('stack', time.perf_counter() - start)
+
+    if cache_dir is not None:
+        save_cached_video(cache_path, frames)
+
+    return frames
+
+
+def save_cached_video(cache_path, frames):
+    """
+    Сохраняет обработанное видео в кэш. Пишет во временный файл и переименовывает, чтобы прерванный запуск
+    не оставил битую запись.
+    """
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, frames)
+    os.replace(tmp_path, cache_path)
+
+
+def process_video_both_sides(video_path, target_size=(224, 224), frame_skip=5, add_third_dimension=False,
+                             cache_dir=None, stats=None, right_video_path=None):
+    """
+    Декодирует видео один раз и получает из каждого кадра обе половины: для левого и для правого надпочечника.
+    Результат совпадает с двумя вызовами process_video с prefix='left' и prefix='right'.
+    right_video_path - путь к той же серии в right_adrenal: запись кэша правой половины привязана к нему, как
+    в update_video_cache (по умолчанию - video_path).
+
+    Возвращает:
+        left_frames (np.ndarray): Массив кадров левой половины (uint8).
+        right_frames (np.ndarray): Массив кадров правой половины (uint8).
+    """
+    if cache_dir is not None:
+        cache_paths = [video_cache_path(cache_dir, side_path, prefix, target_size, frame_skip, add_third_dimension)
+                       for side_path, prefix in zip((video_path, right_video_path or video_path), ('left', 'right'))]
+        if all(os.path.isfile(cache_path) for cache_path in cache_paths):
+            return np.load(cache_paths[0]), np.load(cache_paths[1])
+
+    left_frames = []
+    right_frames = []
+    cap = open_video(video_path, stats)
+    for _, frame in read_sampled_frames(cap, frame_skip, stats):
+        left_frames.append(transform_frame(frame, 'left', target_size, add_third_dimension, stats=stats))
+        right_frames.append(transform_frame(frame, 'right', target_size, add_third_dimension, stats=stats))
+    cap.release()
+
+    start = time.perf_counter()
+    left_frames = np.array(left_frames, dtype=np.uint8)
+    right_frames = np.array(right_frames, dtype=np.uint8)
+    if stats is not None:
+        stats.add_time('stack', time.perf_counter() - start)
+
+    if cache_dir is not None:
+        save_cached_video(cache_paths[0], left_frames)
+        save_cached_video(cache_paths[1], right_frames)
+
+    return left_frames, right_frames
+
+
+def process_video_sizes(video_path, prefix, target_sizes, frame_skip=5, add_third_dimension=False, cache_dir=None,
+                        stats=None, right_video_path=None):
+    """
+    Декодирует видео один раз и получает кадры сразу всех размеров target_sizes (см. transform_frame_sizes).
+    prefix=None - обе половины кадра, как в process_video_both_sides (с тем же right_video_path). Кэш хранится отдельно для каждого размера
+    (см. video_cache_path, cascade_source); декодирование нужно, только если нет хотя бы одной записи.
+
+    Возвращает:
+        list: Для каждого размера - массив кадров (uint8), а при prefix=None - пара (left_frames, right_frames).
+    """
+    prefixes = ('left', 'right') if prefix is None else (prefix,)
+    side_paths = (video_path, right_video_path or video_path) if prefix is None else (video_path,)
+
+    if cache_dir is not None:
+        cache_paths = [[video_cache_path(cache_dir, side_path, side, target_size, frame_skip, add_third_dimension,
+                                         cascade_source(target_sizes, target_size))
+                        for side_path, side in zip(side_paths, prefixes)] for target_size in target_sizes]
+        if all(os.path.isfile(cache_path) for paths in cache_paths for cache_path in paths):
+            results = [[np.load(cache_path) for cache_path in paths] for paths in cache_paths]
+            return [tuple(sides) if prefix is None else sides[0] for sides in results]
+
+    frames = [[[] for _ in prefixes] for _ in target_sizes]
+    cap = open_video(video_path, stats)
+    for _, frame in read_sampled_frames(cap, frame_skip, stats):
+        for side_index, side in enumerate(prefixes):
+            for size_index, sized in enumerate(transform_frame_sizes(frame, side, target_sizes, add_third_dimension,
+                                                                     stats=stats)):
+                frames[size_index][side_index].append(sized)
+    cap.release()
+
+    start = time.perf_counter()
+    results = [[np.array(side_frames, dtype=np.uint8) for side_frames in sides] for sides in frames]
+    if stats is not None:
+        stats.add_time('stack', time.perf_counter() - start)
+
+    if cache_dir is not None:
+        for paths, sides in zip(cache_paths, results):
+            for cache_path, side_frames in zip(paths, sides):
+                save_cached_video(cache_path, side_frames)
+
+    return [tuple(sides) if prefix is None else sides[0] for sides in results]
+
+
+def _process_video_task(args):
+    # Обёртка для ProcessPoolExecutor.map: распаковывает аргументы одного видео.
+    # prefix=None - обе половины кадра (process_video_both_sides), right_video_path - путь right-видео для кэша.
+    # collect_stats=True - возвращает (результат, IngestStats.to_dict()) для объединения в основном процессе
+    # target_size - список размеров: результат process_video_sizes
+    video_path, prefix, target_size, frame_skip, add_third_dimension, cache_dir, collect_stats, right_video_path = args
+    stats = IngestStats() if collect_stats else None
+    if is_multi_size(target_size):
+        result = process_video_sizes(video_path, prefix, target_size, frame_skip, add_third_dimension, cache_dir, stats,
+                                     right_video_path)
+    elif prefix is None:
+        result = process_video_both_sides(video_path, target_size, frame_skip, add_third_dimension, cache_dir, stats,
+                                          right_video_path)
+    else:
+        result = process_video(video_path, prefix, target_size, frame_skip, add_third_dimension, cache_dir, stats)
+    return (result, stats.to_dict()) if collect_stats else result
+
+
+def group_dual_side_tasks(tasks):
+    """
+    Находит в списке видео (см. collect_video_tasks) исследования, которые лежат и в left_adrenal, и в right_adrenal
+    под одним и тем же именем файла, чтобы декодировать их один раз.
+
+    Возвращает:
+        list: Список кортежей (video_path, prefix, indices). Для общих исследований prefix = None, а indices -
+              (индекс left-видео, индекс right-видео); для остальных indices - (индекс видео,).
+    """
+    by_name = {}
+    for index, (video_path, prefix, _) in enumerate(tasks):
+        by_name.setdefault(os.path.basename(video_path), {}).setdefault(prefix, []).append(index)
+
+    grouped = []
+    paired = set()
+    for index, (video_path, prefix, _) in enumerate(tasks):
+        if index in paired:
+            continue
+
+        sides = by_name[os.path.basename(video_path)]
+        if len(sides.get('left', [])) == 1 and len(sides.get('right', [])) == 1:
+            left_index, right_index = sides['left'][0], sides['right'][0]
+            grouped.append((tasks[left_index][0], None, (left_index, right_index)))
+            paired.update((left_index, right_index))
+        else:
+            grouped.append((video_path, prefix, (index,)))
+
+    return grouped
+
+
+def update_video_cache(cache_dir, tasks, target_size=(224, 224), frame_skip=5, add_third_dimension=False,
+                       cascade_from=None):
+    """
+    Сверяет кэш с текущим списком видео (см. collect_video_tasks): удаляет из подпапки текущих параметров
+    устаревшие записи (видео удалено или изменено) и выводит, сколько видео будет взято из кэша, а сколько
+    придется декодировать. Записи для других параметров предобработки не трогаются.
+
+    Возвращает:
+        list: Список видео (video_path), которых нет в кэше.
+    """
+    params_dir = os.path.join(cache_dir, video_cache_params_key(target_size, frame_skip, add_third_dimension,
+                                                                cascade_from))
+    os.makedirs(params_dir, exist_ok=True)
+
+    expected = {}
+    for video_path, prefix, _ in tasks:
+        cache_path = video_cache_path(cache_dir, video_path, prefix, target_size, frame_skip, add_third_dimension,
+                                      cascade_from)
+        expected[os.path.basename(cache_path)] = video_path
+
+    existing = set(os.listdir(params_dir))
+    evicted = 0
+    for file_name in existing - set(expected):
+        try:
+            os.remove(os.path.join(params_dir, file_name))
+            evicted += 1
+        except OSError as e:
+            print(f"Ошибка при удалении {file_name} из кэша: {e}")
+
+    missing = [video_path for file_name, video_path in expected.items() if file_name not in existing]
+    print(f"Кэш {params_dir}: из кэша {len(expected) - len(missing)}, декодируется {len(missing)}, "
+          f"удалено устаревших {evicted}")
+
+    return missing
+
+
+def probe_video_frame_count(video_path, frame_skip=5):
+    """
+    Быстро оценивает число кадров, которое load_videos возьмёт из видео при данном {frame_skip}, без декодирования
+    кадров: берётся CAP_PROP_FRAME_COUNT из контейнера. Если контейнер не сообщает число кадров, кадры
+    пересчитываются через cap.grab() (без retrieve).
+
+    Возвращает:
+        int: Число отобранных кадров.
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Не удалось открыть видеофайл: {video_path}")
+        return 0
+
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    if total_frames <= 0:
+        total_frames = 0
+        while cap.grab():
+            total_frames += 1
+    cap.release()
+
+    return (total_frames + frame_skip - 1) // frame_skip
+
+
+def resample_depth(frames, target_depth, method='uniform'):
+    """
+    Приводит видео к фиксированному числу кадров target_depth (глубине) для входа 3D-модели.
+    Все методы работают сразу над всем массивом кадров, без цикла по кадрам.
+
+    Параметры:
+        frames (np.ndarray): Массив кадров видео формы (число кадров, высота, ширина[, 1]).
+        method (str):
+            'uniform' - равномерная выборка индексов кадров по всей длине видео (кадры повторяются, если их меньше);
+            'linear' - линейная интерполяция между соседними кадрами вдоль оси срезов;
+            'center' - центральная обрезка длинного видео или дополнение короткого нулевыми кадрами с обеих сторон.
+
+    Возвращает:
+        np.ndarray: Массив формы (target_depth, высота, ширина[, 1]) того же типа.
+    """
+    depth = len(frames)
+    if depth == target_depth:
+        return frames
+    if depth == 0:
+        return np.zeros((target_depth,) + frames.shape[1:], dtype=frames.dtype)
+
+    if method == 'uniform':
+        indices = np.round(np.linspace(0, depth - 1, target_depth)).astype(np.int64)
+        return frames[indices]
+
+    if method == 'linear':
+        positions = np.linspace(0, depth - 1, target_depth)
+        lower = np.floor(positions).astype(np.int64)
+        upper = np.minimum(lower + 1, depth - 1)
+        # Вес верхнего кадра, с осями для broadcast по (высота, ширина[, 1])
+        weights = (positions - lower).astype(np.float32).reshape((-1,) + (1,) * (frames.ndim - 1))
+        resampled = frames[lower] * (1 - weights) + frames[upper] * weights
+        return np.rint(resampled).astype(frames.dtype)
+
+    if method == 'center':
+        if depth > target_depth:
+            start = (depth - target_depth) // 2
+            return frames[start:start + target_depth]
+        pad_before = (target_depth - depth) // 2
+        pad_width = [(pad_before, target_depth - depth - pad_before)] + [(0, 0)] * (frames.ndim - 1)
+        return np.pad(frames, pad_width)
+
+    raise ValueError(f"Неизвестный метод приведения глубины: {method}")
+
+
+def resampled_frame_range(frame_count, target_depth=None, method='uniform'):
+    """
+    Положение кадров видео из frame_count кадров после resample_depth, без нулевых кадров дополнения.
+    Применение к уже приведенному числу кадров дает тот же результат.
+
+    Возвращает:
+        tuple: (номер первого кадра, число кадров).
+    """
+    if target_depth is None or frame_count == 0 or frame_count == target_depth:
+        return 0, frame_count
+    if method == 'center' and frame_count < target_depth:
+        return (target_depth - frame_count) // 2, frame_count
+    return 0, target_depth
+
+
+def write_video_to_memmap(videos, index, video_path, prefix, target_size=(224, 224), frame_skip=5,
+                          add_third_dimension=False, cache_dir=None, target_depth=None, resample_method='uniform',
+                          stats=None):
+    """
+    Обрабатывает одно видео и записывает каждый кадр сразу в videos[index] (memmap), не накапливая кадры в памяти.
+    Если в видео больше кадров, чем выделено в массиве, лишние кадры отбрасываются.
+    Если задан cache_dir, видео берется из кэша (см. process_video). Если задан target_depth, видео сначала
+    приводится к target_depth кадрам (см. resample_depth), для этого в памяти держится одно видео.
+    stats (IngestStats) - необязательные замеры этапов обработки.
+
+    Возвращает:
+        int: Число записанных кадров видео, без нулевых кадров дополнения resample_depth (см. resampled_frame_range).
+    """
+    max_frames = videos.shape[1]
+    written = 0
+    if cache_dir is not None or target_depth is not None:
+        frames = process_video(video_path, prefix, target_size, frame_skip, add_third_dimension, cache_dir, stats)
+        _, frame_count = resampled_frame_range(len(frames), target_depth, resample_method)
+        if target_depth is not None:
+            frames = resample_depth(frames, target_depth, resample_method)
+        written = min(len(frames), max_frames)
+        videos[index, :written] = frames[:written]
+        if len(frames) > max_frames:
+            print(f"Предупреждение: в видео {video_path} больше {max_frames} кадров, лишние кадры отброшены")
+        return min(frame_count, max_frames)
+
+    # Кадр обрабатывается сразу в строку memmap, без промежуточного массива
+    cap = open_video(video_path, stats)
+    for _, frame in read_sampled_frames(cap, frame_skip, stats):
+        if written >= max_frames:
+            print(f"Предупреждение: в видео {video_path} больше {max_frames} кадров, лишние кадры отброшены")
+            break
+        transform_frame(frame, prefix, target_size, add_third_dimension, out=videos[index, written], stats=stats)
+        written += 1
+    cap.release()
+
+    return written
+
+
+def write_video_to_memmaps(videos_list, index, video_path, prefix, target_sizes, frame_skip=5,
+                           add_third_dimension=False, cache_dir=None, target_depth=None, resample_method='uniform',
+                           stats=None):
+    """
+    То же, что write_video_to_memmap, но для нескольких размеров сразу: видео декодируется один раз, и каждый кадр
+    записывается в videos_list[k][index] для размера target_sizes[k] (см. transform_frame_sizes).
+
+    Возвращает:
+        int: Число записанных кадров видео, без нулевых кадров дополнения resample_depth (см. resampled_frame_range).
+    """
+    max_frames = videos_list[0].shape[1]
+    written = 0
+    if cache_dir is not None or target_depth is not None:
+        sized_frames = process_video_sizes(video_path, prefix, target_sizes, frame_skip, add_third_dimension,
+                                           cache_dir, stats)
+        _, frame_count = resampled_frame_range(len(sized_frames[0]), target_depth, resample_method)
+        for videos, frames in zip(videos_list, sized_frames):
+            if target_depth is not None:
+                frames = resample_depth(frames, target_depth, resample_method)
+            written = min(len(frames), max_frames)
+            videos[index, :written] = frames[:written]
+        if target_depth is None and len(sized_frames[0]) > max_frames:
+            print(f"Предупреждение: в видео {video_path} больше {max_frames} кадров, лишние кадры отброшены")
+        return min(frame_count, max_frames)
+
+    # Кадры всех размеров обрабатываются сразу в строки memmap
+    cap = open_video(video_path, stats)
+    for _, frame in read_sampled_frames(cap, frame_skip, stats):
+        if written >= max_frames:
+            print(f"Предупреждение: в видео {video_path} больше {max_frames} кадров, лишние кадры отброшены")
+            break
+        transform_frame_sizes(frame, prefix, target_sizes, add_third_dimension,
+                              outs=[videos[index, written] for videos in videos_list], stats=stats)
+        written += 1
+    cap.release()
+
+    return written
+
+
+def _write_video_task(args):
+    # Обёртка для ProcessPoolExecutor.map: каждый процесс открывает .npy-файл в режиме r+ и пишет в свою строку.
+    # Если target_size - список размеров, output_file - список файлов (по одному на размер)
+    (output_file, index, video_path, prefix, target_size, frame_skip, add_third_dimension, cache_dir,
+     target_depth, resample_method, collect_stats) = args
+    stats = IngestStats() if collect_stats else None
+    if is_multi_size(target_size):
+        videos_list = [np.load(sized_file, mmap_mode='r+') for sized_file in output_file]
+        written = write_video_to_memmaps(videos_list, index, video_path, prefix, target_size, frame_skip,
+                                         add_third_dimension, cache_dir, target_depth, resample_method, stats)
+        for videos in videos_list:
+            videos.flush()
+        del videos_list
+    else:
+        videos = np.load(output_file, mmap_mode='r+')
+        written = write_video_to_memmap(videos, index, video_path, prefix, target_size, frame_skip,
+                                        add_third_dimension, cache_dir, target_depth, resample_method, stats)
+        videos.flush()
+        del videos
+    return (written, stats.to_dict()) if collect_stats else written
+
+
+def sized_output_file(output_file, target_size):
+    # Путь к файлу одного из нескольких размеров: videos.npy -> videos_112x112.npy
+    root, ext = os.path.splitext(output_file)
+    return f"{root}_{target_size[0]}x{target_size[1]}{ext}"
+
+
+def make_label(prefix, class_name):
+    """
+    Формирует метку видео по стороне надпочечника и имени папки класса.
+
+    Возвращает:
+        label : Метка в виде списка из трех чисел. [0 0 1]
+        formatted_label_name : Имя метки. 'left_001'
+    """
+    # Генерируем метку в виде массива из трех чисел
+    class_parts = class_name.split('_')[1:]
+    label = [np.uint8(int(class_parts[i])) for i in range(3)]
+
+    # Генерируем имя метки в виде left_001 или right_001
+    formatted_label_name = f"{prefix}_{''.join(class_parts)}"
+
+    return label, formatted_label_name
+
+
+def load_videos_to_memmap(tasks, output_file, target_size=(224, 224), frame_skip=5, add_third_dimension=False,
+                          workers=None, cache_dir=None, target_depth=None, resample_method='uniform', stats=None,
+                          pipeline_threads=None, intensity_stats=None, label_names=None, frame_counts=None):
+    """
+    Потоково записывает обработанные видео в заранее выделенный .npy-файл (np.memmap), размер которого определяется
+    быстрым проходом probe_video_frame_count. Пиковое потребление памяти - порядка одного кадра на процесс,
+    независимо от размера датасета. Видео короче самого длинного дополняются нулевыми кадрами.
+    Если задан target_depth, все видео приводятся к target_depth кадрам (см. resample_depth) и проход не нужен.
+    Если target_size - список размеров, для каждого размера пишется свой файл sized_output_file(output_file, размер)
+    за один проход декодирования (см. write_video_to_memmaps).
+    Если задан pipeline_threads, кадры пишутся в файл конвейерно (см. load_videos_pipelined).
+    Если передан intensity_stats (IntensityStats), в него добавляются записанные кадры каждого видео (без кадров
+    дополнения) с метками label_names; для списка размеров - кадры первого размера.
+    Если передан список frame_counts, в него добавляется число записанных кадров каждого видео (без кадров дополнения).
+
+    Возвращает:
+        np.memmap: Массив видео формы (число видео, число кадров, высота, ширина[, 1]), открытый только для чтения.
+                   Для списка размеров - словарь {(ширина, высота): np.memmap}.
+    """
+    if target_depth is not None:
+        max_frames = target_depth
+    else:
+        probed_counts = [probe_video_frame_count(video_path, frame_skip) for video_path, _, _ in tasks]
+        max_frames = max(probed_counts, default=0)
+        if len(set(probed_counts)) > 1:
+            print(f"Предупреждение: число кадров в видео различается ({min(probed_counts)}-{max_frames}), "
+                  f"короткие видео будут дополнены нулевыми кадрами")
+
+    if is_multi_size(target_size):
+        target_sizes = [tuple(size) for size in target_size]
+        output_files = [sized_output_file(output_file, size) for size in target_sizes]
+        for size, sized_file in zip(target_sizes, output_files):
+            shape = (len(tasks), max_frames, size[1], size[0]) + ((1,) if add_third_dimension else ())
+            videos = np.lib.format.open_memmap(sized_file, mode='w+', dtype=np.uint8, shape=shape)
+            videos.flush()
+            del videos
+
+        if workers is not None and workers > 1:
+            task_args = [(output_files, index, video_path, prefix, target_sizes, frame_skip, add_third_dimension,
+                          cache_dir, target_depth, resample_method, stats is not None)
+                         for index, (video_path, prefix, _) in enumerate(tasks)]
+            written = list(_imap_ingest_tasks(_write_video_task, task_args, workers, stats))
+        else:
+            videos_list = [np.load(sized_file, mmap_mode='r+') for sized_file in output_files]
+            written = [write_video_to_memmaps(videos_list, index, video_path, prefix, target_sizes, frame_skip,
+                                              add_third_dimension, cache_dir, target_depth, resample_method, stats)
+                       for index, (video_path, prefix, _) in enumerate(tasks)]
+            for videos in videos_list:
+                videos.flush()
+            del videos_list
+
+        sized_videos = {size: np.load(sized_file, mmap_mode='r') for size, sized_file in zip(target_sizes, output_files)}
+        if frame_counts is not None:
+            frame_counts.extend(written)
+        if intensity_stats is not None:
+            update_intensity_stats(intensity_stats, sized_videos[target_sizes[0]], written, label_names, target_depth,
+                                   resample_method)
+        return sized_videos
+
+    shape = (len(tasks), max_frames, target_size[1], target_size[0])
+    if add_third_dimension:
+        shape += (1,)
+
+    videos = np.lib.format.open_memmap(output_file, mode='w+', dtype=np.uint8, shape=shape)
+
+    if pipeline_threads is not None:
+        written = load_videos_pipelined(tasks, target_size, frame_skip, add_third_dimension, *pipeline_threads,
+                                        videos=videos, stats=stats)
+        videos.flush()
+        del videos
+    elif workers is not None and workers > 1:
+        # Сначала сбрасываем заголовок и размер файла на диск, затем процессы пишут каждый в свою строку
+        videos.flush()
+        del videos
+        task_args = [(output_file, index, video_path, prefix, target_size, frame_skip, add_third_dimension, cache_dir,
+                      target_depth, resample_method, stats is not None)
+                     for index, (video_path, prefix, _) in enumerate(tasks)]
+        written = list(_imap_ingest_tasks(_write_video_task, task_args, workers, stats))
+    else:
+        written = [write_video_to_memmap(videos, index, video_path, prefix, target_size, frame_skip,
+                                         add_third_dimension, cache_dir, target_depth, resample_method, stats)
+                   for index, (video_path, prefix, _) in enumerate(tasks)]
+        videos.flush()
+        del videos
+
+    videos = np.load(output_file, mmap_mode='r')
+    if frame_counts is not None:
+        frame_counts.extend(written)
+    if intensity_stats is not None:
+        update_intensity_stats(intensity_stats, videos, written, label_names, target_depth, resample_method)
+    return videos
+
+
+def update_intensity_stats(intensity_stats, videos, frame_counts, label_names, target_depth=None,
+                           resample_method='uniform'):
+    # Добавляет в IntensityStats frame_counts[i] кадров каждого видео без нулевых кадров дополнения: в конце видео,
+    # а для target_depth с resample_method='center' - с обеих сторон (см. resampled_frame_range)
+    for video, frame_count, label_name in zip(videos, frame_counts, label_names):
+        start, frame_count = resampled_frame_range(frame_count, target_depth, resample_method)
+        intensity_stats.update(video[start:start + frame_count], label_name)
+
+
+# Число исходных кадров в очереди между потоками декодирования и обработки в load_videos_pipelined
+PIPELINE_QUEUE_SIZE = 64
+
+
+def load_videos_pipelined(tasks, target_size=(224, 224), frame_skip=5, add_third_dimension=False, decode_threads=2,
+                          transform_threads=2, queue_size=PIPELINE_QUEUE_SIZE, videos=None, stats=None):
+    """
+    Конвейерная загрузка видео: потоки декодирования открывают видео и читают кадры (см. read_sampled_frames)
+    в общую очередь, а потоки обработки берут из нее кадры и выполняют transform_frame. OpenCV отпускает GIL
+    на декодировании, cvtColor и resize, поэтому открытие и декодирование следующих видео идут одновременно
+    с обработкой кадров. Очередь ограничена queue_size кадрами: если обработка отстает, декодирование ждет,
+    и одновременно в памяти не больше queue_size исходных кадров. Результат совпадает с последовательной загрузкой.
+
+    Параметры:
+        tasks (list): Список видео (см. collect_video_tasks).
+        videos (np.memmap): Если передан, кадры пишутся сразу в videos[индекс видео, номер кадра]
+                            (см. load_videos_to_memmap), лишние кадры отбрасываются.
+        stats (IngestStats): Если передан, каждый поток ведет свои замеры, которые затем объединяются.
+
+    Возвращает:
+        list: Для каждого видео в порядке tasks - массив кадров (uint8), а если передан videos - число записанных кадров.
+    """
+    task_queue = queue.Queue()
+    for index in range(len(tasks)):
+        task_queue.put(index)
+    frame_queue = queue.Queue(maxsize=queue_size)
+
+    frames = [{} for _ in tasks]  # Для каждого видео: номер кадра -> обработанный кадр
+    frame_counts = [0] * len(tasks)
+    max_frames = videos.shape[1] if videos is not None else None
+    thread_stats = []
+    errors = []
+
+    def decode():
+        local_stats = IngestStats() if stats is not None else None
+        try:
+            while True:
+                try:
+                    index = task_queue.get_nowait()
+                except queue.Empty:
+                    break
+                cap = open_video(tasks[index][0], local_stats)
+                position = 0
+                for _, frame in read_sampled_frames(cap, frame_skip, local_stats):
+                    frame_queue.put((index, position, frame))  # Ждет, если очередь заполнена
+                    position += 1
+                cap.release()
+                frame_counts[index] = position
+        except Exception as e:
+            errors.append(e)
+        if local_stats is not None:
+            thread_stats.append(local_stats)
+
+    def transform():
+        local_stats = IngestStats() if stats is not None else None
+        while True:
+            item = frame_queue.get()
+            if item is None:
+                break
+            index, position, frame = item
+            video_path, prefix, _ = tasks[index]
+            # Ошибка не останавливает поток, иначе декодирование зависнет на заполненной очереди
+            try:
+                if local_stats is not None:
+                    local_stats.start_video(video_path)
+                if videos is None:
+                    frames[index][position] = transform_frame(frame, prefix, target_size, add_third_dimension,
+                                                              stats=local_stats)
+                elif position < max_frames:
+                    transform_frame(frame, prefix, target_size, add_third_dimension, out=videos[index, position],
+                                    stats=local_stats)
+            except Exception as e:
+                errors.append(e)
+        if local_stats is not None:
+            thread_stats.append(local_stats)
+
+    decoders = [threading.Thread(target=decode) for _ in range(decode_threads)]
+    transformers = [threading.Thread(target=transform) for _ in range(transform_threads)]
+    for thread in decoders + transformers:
+        thread.start()
+    for thread in decoders:
+        thread.join()
+    for _ in transformers:
+        frame_queue.put(None)
+    for thread in transformers:
+        thread.join()
+
+    if stats is not None:
+        for local_stats in thread_stats:
+            stats.merge(local_stats.to_dict())
+    if errors:
+        raise errors[0]
+
+    if videos is not None:
+        for (video_path, _, _), frame_count in zip(tasks, frame_counts):
+            if frame_count > max_frames:
+                print(f"Предупреждение: в видео {video_path} больше {max_frames} кадров, лишние кадры отброшены")
+        return [min(frame_count, max_frames) for frame_count in frame_counts]
+
+    # Кадры каждого видео освобождаются сразу после сборки массива
+    start = time.perf_counter()
+    processed = []
+    for index, frame_count in enumerate(frame_counts):
+        processed.append(np.array([frames[index][position] for position in range(frame_count)], dtype=np.uint8))
+        frames[index] = None
+    if stats is not None:
+        stats.add_time('stack', time.perf_counter() - start)
+
+    return processed
+
+
+# функция для загрузки и обработки видео с уменьшением количества и размера кадров.
+def load_videos(data_dir, target_size=(224, 224), frame_skip=5, add_third_dimension=False, workers=None,
+                output_file=None, cache_dir=None, dual_side=False, target_depth=None, resample_method='uniform',
+                stats=None, pipeline_threads=None, duplicates_report=None, rois=None, intensity_stats=None,
+                frame_counts=None):
+    """
+      Функция загружает видео из указанной директории, обрабатывает их (уменьшает количество кадров, уменьшает размер) и
+      сохраняет в виде массивов.
+
+      Параметры:
+          target_size: Размер кадра (ширина, высота) или список размеров [(224, 224), (160, 160), (112, 112)].
+                       Для списка каждое видео декодируется один раз, меньшие размеры получаются каскадным
+                       уменьшением (см. transform_frame_sizes), а videos возвращается словарем
+                       {(ширина, высота): массив видео}; с output_file каждый размер пишется в свой файл
+                       (см. sized_output_file).
+          workers (int): Число процессов для параллельного декодирования видео. None или 1 - последовательная обработка
+                         в текущем процессе. Порядок результатов не зависит от числа процессов.
+          output_file (str): Путь к .npy-файлу. Если задан, кадры пишутся сразу в заранее выделенный файл
+                             (см. load_videos_to_memmap), а videos возвращается как np.memmap только для чтения.
+          cache_dir (str): Папка кэша обработанных видео. Если задана, декодируются только новые или измененные
+                           видео, остальные берутся из кэша, устаревшие записи удаляются (см. update_video_cache).
+          dual_side (bool): Исследования, которые лежат и в left_adrenal, и в right_adrenal под одним именем,
+                            декодируются один раз с получением обеих половин (см. process_video_both_sides).
+                            Не используется вместе с output_file (ValueError).
+          target_depth (int): Если задан, каждое видео приводится к target_depth кадрам, чтобы все видео имели
+                              одинаковую форму для 3D-модели (см. resample_depth).
+          resample_method (str): Метод приведения к target_depth: 'uniform', 'linear' или 'center'.
+          stats (IngestStats): Если передан, в него записываются время этапов и счетчики по каждому видео
+                               (в том числе из процессов-обработчиков). Сохранить в JSON: stats.save_json(path).
+          pipeline_threads (tuple): (потоков декодирования, потоков обработки). Если задан, видео загружаются
+                                    конвейерно в одном процессе (см. load_videos_pipelined), workers не используется.
+                                    Не используется вместе с cache_dir, dual_side и списком размеров, а с output_file -
+                                    вместе с target_depth.
+          duplicates_report: Отчет find_duplicate_videos (путь к CSV или pd.DataFrame): дубликаты не загружаются
+                             (см. collect_video_tasks).
+          rois (list): Области тела (x, y, ширина, высота) для каждого видео в порядке collect_video_tasks
+                       (см. estimate_body_rois). Кадр обрезается по области вместо половины кадра, None в списке -
+                       половина кадра. Не используется вместе с dual_side.
+          intensity_stats (IntensityStats): Если передан, во время загрузки в него добавляются кадры каждого видео
+                                            (среднее, отклонение и гистограммы яркости по датасету и классам),
+                                            без кадров дополнения; для списка размеров - кадры первого размера.
+                                            Сохранить рядом с массивами: intensity_stats.save_json(path).
+          frame_counts (list): Если передан, в него добавляется настоящее число кадров каждого видео (без нулевых
+                               кадров дополнения до самого длинного видео) - для save_metadata_index(frame_counts=...).
+
+      Возвращает:
+          videos : Массив обработанных видео.
+          labels : Массив меток классов. [0 0 1]
+          label_names : Список имен меток. 'left_001'
+      """
+
+    videos = []
+    labels = []
+    formatted_label_names = []
+    tasks = collect_video_tasks(data_dir, duplicates_report)
+
+    for _, prefix, class_name in tasks:
+        label, formatted_label_name = make_label(prefix, class_name)
+        labels.append(label)
+        formatted_label_names.append(formatted_label_name)
+
+    multi_size = is_multi_size(target_size)
+    target_sizes = [tuple(size) for size in target_size] if multi_size else [target_size]
+
+    if rois is not None:
+        if dual_side:
+            raise ValueError("Области тела (rois) не используются вместе с dual_side")
+        if len(rois) != len(tasks):
+            raise ValueError(f"Число областей тела ({len(rois)}) не совпадает с числом видео ({len(tasks)})")
+        # Дальше вместо стороны передается область обрезки (см. transform_frame); метки уже построены по сторонам
+        tasks = [(video_path, tuple(roi) if roi is not None else prefix, class_name)
+                 for (video_path, prefix, class_name), roi in zip(tasks, rois)]
+
+    if dual_side and output_file is not None:
+        raise ValueError("Совместная обработка сторон (dual_side) не используется вместе с output_file")
+
+    if pipeline_threads is not None and (cache_dir is not None or dual_side or multi_size or
+                                         (output_file is not None and target_depth is not None)):
+        raise ValueError("Конвейерная загрузка (pipeline_threads) не поддерживает cache_dir, dual_side, "
+                         "список размеров и target_depth вместе с output_file")
+
+    if cache_dir is not None:
+        for size in target_sizes:
+            update_video_cache(cache_dir, tasks, size, frame_skip, add_third_dimension,
+                               cascade_source(target_sizes, size) if multi_size else None)
+
+    if output_file is not None:
+        videos = load_videos_to_memmap(tasks, output_file, target_size, frame_skip, add_third_dimension, workers,
+                                       cache_dir, target_depth, resample_method, stats, pipeline_threads,
+                                       intensity_stats, formatted_label_names, frame_counts)
+        return videos, np.array(labels, dtype=np.int64), formatted_label_names
+
+    if pipeline_threads is not None:
+        videos = load_videos_pipelined(tasks, target_size, frame_skip, add_third_dimension, *pipeline_threads,
+                                       stats=stats)
+        counts = [resampled_frame_range(len(frames), target_depth, resample_method)[1] for frames in videos]
+        if target_depth is not None:
+            videos = [resample_depth(frames, target_depth, resample_method) for frames in videos]
+        if frame_counts is not None:
+            frame_counts.extend(counts)
+        if intensity_stats is not None:
+            update_intensity_stats(intensity_stats, videos, counts, formatted_label_names, target_depth,
+                                   resample_method)
+
+        start = time.perf_counter()
+        videos = np.array(videos, dtype=np.uint8)
+        if stats is not None:
+            stats.add_time('stack_all', time.perf_counter() - start)
+
+        return videos, np.array(labels, dtype=np.int64), formatted_label_names
+
+    if dual_side:
+        grouped = group_dual_side_tasks(tasks)
+    else:
+        grouped = [(video_path, prefix, (index,)) for index, (video_path, prefix, _) in enumerate(tasks)]
+
+    task_args = [(video_path, prefix, target_sizes if multi_size else target_size, frame_skip, add_third_dimension,
+                  cache_dir, stats is not None, tasks[indices[1]][0] if prefix is None else None)
+                 for video_path, prefix, indices in grouped]
+    # Параллельное декодирование при workers > 1: порядок результатов совпадает с порядком обхода директорий
+    processed = list(_imap_ingest_tasks(_process_video_task, task_args, workers, stats))
+
+    if not multi_size:
+        processed = [[result] for result in processed]
+
+    sized_videos = {}
+    for size_index, size in enumerate(target_sizes):
+        videos = [None] * len(tasks)
+        for (_, prefix, indices), result in zip(grouped, processed):
+            if prefix is None:
+                videos[indices[0]], videos[indices[1]] = result[size_index]
+            else:
+                videos[indices[0]] = result[size_index]
+
+        counts = [resampled_frame_range(len(frames), target_depth, resample_method)[1] for frames in videos]
+        if target_depth is not None:
+            videos = [resample_depth(frames, target_depth, resample_method) for frames in videos]
+        if frame_counts is not None and size_index == 0:
+            frame_counts.extend(counts)
+        if intensity_stats is not None and size_index == 0:
+            update_intensity_stats(intensity_stats, videos, counts, formatted_label_names, target_depth,
+                                   resample_method)
+
+        start = time.perf_counter()
+        sized_videos[tuple(size)] = np.array(videos, dtype=np.uint8)
+        if stats is not None:
+            stats.add_time('stack_all', time.perf_counter() - start)
+
+    videos = sized_videos if multi_size else sized_videos.popitem()[1]
+
+    return videos, np.array(labels, dtype=np.int64), formatted_label_names
+
+
+PACKED_FRAMES_FILE = 'frames.bin'
+PACKED_INDEX_FILE = 'index.npz'
+
+
+class PackedVideos:
+    """
+    Читает упакованный датасет, созданный save_packed_videos. Все кадры всех видео лежат подряд в одном
+    файле frames.bin (uint8), который открывается через np.memmap, поэтому открытие датасета не читает кадры с диска.
+    videos[i] возвращает i-е видео как view без копирования, формы (число кадров i-го видео, высота, ширина[, 1]).
+
+    Атрибуты:
+        offsets (np.ndarray): Индекс первого кадра каждого видео в frames.bin (int64).
+        lengths (np.ndarray): Число кадров каждого видео (int64).
+        labels (np.ndarray): Массив меток классов. [0 0 1]
+        label_names (np.ndarray): Имена меток. 'left_001'
+    """
+
+    def __init__(self, packed_dir):
+        index = np.load(os.path.join(packed_dir, PACKED_INDEX_FILE))
+        self.offsets = index['offsets']
+        self.lengths = index['lengths']
+        self.labels = index['labels']
+        self.label_names = index['label_names']
+        self.frame_shape = tuple(int(x) for x in index['frame_shape'])
+
+        total_frames = int(self.lengths.sum())
+        if total_frames > 0:
+            self.frames = np.memmap(os.path.join(packed_dir, PACKED_FRAMES_FILE), dtype=np.uint8, mode='r',
+                                    shape=(total_frames,) + self.frame_shape)
+        else:
+            self.frames = np.empty((0,) + self.frame_shape, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, i):
+        start = self.offsets[i]
+        return self.frames[start:start + self.lengths[i]]
+
+
+def save_packed_videos(data_dir, packed_dir, target_size=(224, 224), frame_skip=5, add_third_dimension=False,
+                       workers=None, cache_dir=None):
+    """
+    Обрабатывает видео так же, как load_videos, но сохраняет их в упакованном формате, который допускает разное
+    число кадров в видео:
+        packed_dir/
+            ├── frames.bin  - кадры всех видео подряд (uint8), пишутся потоково, по одному кадру
+            └── index.npz   - offsets и lengths (int64), labels, label_names, frame_shape
+    Если задан cache_dir, видео берутся из кэша обработанных видео (см. load_videos).
+
+    Возвращает:
+        PackedVideos: Упакованный датасет, открытый для чтения.
+    """
+    os.makedirs(packed_dir, exist_ok=True)
+    tasks = collect_video_tasks(data_dir)
+
+    labels = []
+    formatted_label_names = []
+    for _, prefix, class_name in tasks:
+        label, formatted_label_name = make_label(prefix, class_name)
+        labels.append(label)
+        formatted_label_names.append(formatted_label_name)
+
+    if cache_dir is not None:
+        update_video_cache(cache_dir, tasks, target_size, frame_skip, add_third_dimension)
+
+    frame_shape = (target_size[1], target_size[0]) + ((1,) if add_third_dimension else ())
+    lengths = np.zeros(len(tasks), dtype=np.int64)
+
+    with open(os.path.join(packed_dir, PACKED_FRAMES_FILE), 'wb') as f:
+        if workers is not None and workers > 1:
+            task_args = [(video_path, prefix, target_size, frame_skip, add_third_dimension, cache_dir, False, None)
+                         for video_path, prefix, _ in tasks]
+            for index, frames in enumerate(_imap_ingest_tasks(_process_video_task, task_args, workers)):
+                f.write(frames.tobytes())
+                lengths[index] = len(frames)
+        else:
+            for index, (video_path, prefix, _) in enumerate(tasks):
+                if cache_dir is not None:
+                    frames = process_video(video_path, prefix, target_size, frame_skip, add_third_dimension, cache_dir)
+                else:
+                    frames = iter_processed_frames(video_path, prefix, target_size, frame_skip, add_third_dimension)
+                for frame in frames:
+                    f.write(frame.tobytes())
+                    lengths[index] += 1
+
+    offsets = np.zeros(len(tasks), dtype=np.int64)
+    if len(tasks) > 0:
+        offsets[1:] = np.cumsum(lengths)[:-1]
+
+    np.savez(os.path.join(packed_dir, PACKED_INDEX_FILE),
+             offsets=offsets,
+             lengths=lengths,
+             labels=np.array(labels, dtype=np.int64).reshape(-1, 3),
+             label_names=np.array(formatted_label_names, dtype=str),
+             frame_shape=np.array(frame_shape, dtype=np.int64))
+
+    print(f"Упакованный датасет сохранен в: {packed_dir} ({len(tasks)} видео, {int(lengths.sum())} кадров)")
+
+    return PackedVideos(packed_dir)
+
+
+class CompressedVideos:
+    """
+    Читает сжатый датасет, созданный save_compressed_videos. Файл - это .npz (zip), в котором каждое видео
+    хранится отдельными сжатыми кусками по chunk_frames кадров, поэтому videos[i] распаковывает только куски i-го
+    видео, не читая остальной файл.
+
+    Атрибуты:
+        lengths (np.ndarray): Число кадров каждого видео (int64).
+        labels (np.ndarray): Массив меток классов. [0 0 1]
+        label_names (np.ndarray): Имена меток. 'left_001'
+    """
+
+    def __init__(self, compressed_file):
+        self.npz = np.load(compressed_file)
+        self.lengths = self.npz['lengths']
+        self.chunk_counts = self.npz['chunk_counts']
+        self.labels = self.npz['labels']
+        self.label_names = self.npz['label_names']
+        self.frame_shape = tuple(int(x) for x in self.npz['frame_shape'])
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, i):
+        chunks = [self.npz[f"video_{i:06d}_chunk_{j:04d}"] for j in range(self.chunk_counts[i])]
+        if not chunks:
+            return np.empty((0,) + self.frame_shape, dtype=np.uint8)
+        return np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+
+    def close(self):
+        self.npz.close()
+
+
+def _write_npz_member(zf, name, array):
+    # Запись одного массива в .npz без предварительной сборки всех массивов в памяти
+    with zf.open(f"{name}.npy", 'w', force_zip64=True) as f:
+        np.lib.format.write_array(f, np.asarray(array), allow_pickle=False)
+
+
+def save_compressed_videos(videos, labels, label_names, compressed_file, chunk_frames=None, compresslevel=6):
+    """
+    Сохраняет видео в сжатый .npz с произвольным доступом к одному видео (см. CompressedVideos).
+    Кадры КТ в основном состоят из черного фона, поэтому хорошо сжимаются (zlib).
+
+    Параметры:
+        videos: Видео - np.ndarray / np.memmap из load_videos или PackedVideos. Каждое видео пишется отдельно.
+        chunk_frames (int): Число кадров в одном сжатом куске. None - одно видео целиком в одном куске.
+        compresslevel (int): Уровень сжатия zlib (1-9).
+
+    Возвращает:
+        int: Размер файла в байтах.
+    """
+    lengths = np.zeros(len(videos), dtype=np.int64)
+    chunk_counts = np.zeros(len(videos), dtype=np.int64)
+    frame_shape = None
+
+    with zipfile.ZipFile(compressed_file, mode='w', compression=zipfile.ZIP_DEFLATED,
+                         compresslevel=compresslevel, allowZip64=True) as zf:
+        for i in range(len(videos)):
+            video = np.asarray(videos[i], dtype=np.uint8)
+            frame_shape = video.shape[1:]
+            lengths[i] = len(video)
+
+            step = chunk_frames or max(len(video), 1)
+            for j, start in enumerate(range(0, len(video), step)):
+                _write_npz_member(zf, f"video_{i:06d}_chunk_{j:04d}", video[start:start + step])
+                chunk_counts[i] += 1
+
+        _write_npz_member(zf, 'lengths', lengths)
+        _write_npz_member(zf, 'chunk_counts', chunk_counts)
+        _write_npz_member(zf, 'labels', np.array(labels, dtype=np.int64))
+        _write_npz_member(zf, 'label_names', np.array(label_names, dtype=str))
+        _write_npz_member(zf, 'frame_shape', np.array(frame_shape or (), dtype=np.int64))
+
+    return os.path.getsize(compressed_file)
+
+
+ROI_COLUMNS = ('roi_x', 'roi_y', 'roi_width', 'roi_height')
+
+
+def save_metadata_index(index_file, tasks, videos, rois=None, frame_counts=None):
+    """
+    Сохраняет рядом с массивами небольшой CSV-индекс датасета, по строке на видео: исходный путь, сторона,
+    код класса, имя метки, число кадров, форма видео, смещение в байтах и размер в байтах. Статистику датасета
+    и разбиение на выборки можно строить по индексу, не загружая videos.npy.
+
+    Параметры:
+        tasks: Список видео из collect_video_tasks (в том же порядке, что и в videos).
+        videos: Результат load_videos (np.ndarray или np.memmap из .npy) или PackedVideos.
+                Для np.ndarray смещение считается для файла, сохраненного через np.save;
+                для PackedVideos - смещение в frames.bin.
+        rois (list): Области тела, по которым обрезались кадры (см. estimate_body_rois). Записываются в столбцы
+                     roi_x, roi_y, roi_width, roi_height.
+        frame_counts: Настоящее число кадров каждого видео (load_videos(frame_counts=...)). В np.ndarray и np.memmap
+                      короткие видео дополнены нулевыми кадрами до videos.shape[1], поэтому без frame_counts
+                      в столбец frames записывается полная глубина массива.
+
+    Возвращает:
+        pd.DataFrame: Индекс.
+    """
+    if isinstance(videos, PackedVideos):
+        frame_bytes = int(np.prod(videos.frame_shape))
+        frame_counts = videos.lengths
+        byte_offsets = videos.offsets * frame_bytes
+        shapes = [(int(length),) + videos.frame_shape for length in videos.lengths]
+    else:
+        if isinstance(videos, np.memmap):
+            data_offset = videos.offset
+        else:
+            # Размер заголовка, который запишет np.save
+            header = io.BytesIO()
+            np.lib.format.write_array_header_1_0(header, np.lib.format.header_data_from_array_1_0(videos))
+            data_offset = header.tell()
+        study_bytes = int(np.prod(videos.shape[1:])) * videos.itemsize
+        if frame_counts is None:
+            frame_counts = np.full(len(videos), videos.shape[1] if videos.ndim > 1 else 0, dtype=np.int64)
+        byte_offsets = data_offset + np.arange(len(videos), dtype=np.int64) * study_bytes
+        shapes = [tuple(videos.shape[1:])] * len(videos)
+
+    rows = []
+    for i, (video_path, prefix, class_name) in enumerate(tasks):
+        _, label_name = make_label(prefix, class_name)
+        rows.append({
+            'video_path': video_path,
+            'side': prefix,
+            'class_code': label_name.split('_')[1],
+            'label_name': label_name,
+            'frames': int(frame_counts[i]),
+            'shape': 'x'.join(str(x) for x in shapes[i]),
+            'byte_offset': int(byte_offsets[i]),
+            'size_bytes': int(np.prod(shapes[i])),
+        })
+        if rois is not None:
+            roi = rois[i] if rois[i] is not None else (np.nan,) * 4
+            rows[-1].update(zip(ROI_COLUMNS, roi))
+
+    columns = ['video_path', 'side', 'class_code', 'label_name', 'frames', 'shape', 'byte_offset', 'size_bytes']
+    index = pd.DataFrame(rows, columns=columns + (list(ROI_COLUMNS) if rois is not None else []))
+    index.to_csv(index_file, index=False)
+
+    return index
+
+
+def load_metadata_index(index_file):
+    """
+    Загружает индекс, сохраненный save_metadata_index.
+
+    Возвращает:
+        pd.DataFrame: Индекс (class_code читается как строка, например '001').
+    """
+    return pd.read_csv(index_file, dtype={'class_code': str})
+
+
+def split_metadata_index(index, val_fraction=0.2, seed=0):
+    """
+    Делит датасет на обучающую и валидационную выборки по индексу (без загрузки видео) с сохранением
+    доли каждого класса label_name (стратифицированно). Перед перемешиванием видео класса сортируются
+    по video_path, поэтому разбиение зависит только от seed, а не от порядка файлов в папках (os.listdir).
+
+    Возвращает:
+        train_indices (np.ndarray): Номера видео обучающей выборки.
+        val_indices (np.ndarray): Номера видео валидационной выборки.
+    """
+    rng = np.random.default_rng(seed)
+    train_indices = []
+    val_indices = []
+    for _, group in index.groupby('label_name', sort=True):
+        positions = rng.permutation(group.sort_values('video_path', kind='stable').index.to_numpy())
+        n_val = int(round(len(positions) * val_fraction))
+        val_indices.extend(positions[:n_val])
+        train_indices.extend(positions[n_val:])
+
+    return np.sort(np.array(train_indices, dtype=np.int64)), np.sort(np.array(val_indices, dtype=np.int64))
+
+
+SHARD_DIR_FORMAT = 'shard_{:03d}'
+SHARD_MANIFEST_FILE = 'shards.csv'
+
+
+def assign_shards(label_names, n_shards, seed=0, keys=None):
+    """
+    Распределяет видео по n_shards шардам с сохранением долей классов: видео каждого класса (label_names,
+    16 сочетаний left_/right_ x class_X_Y_Z) перемешиваются и раздаются по шардам по кругу, а следующий класс
+    продолжает раздачу с того шарда, на котором остановился предыдущий. Поэтому число видео каждого класса,
+    как и общее число видео, в разных шардах отличается не больше чем на 1.
+
+    Параметры:
+        keys: Ключи видео для сортировки перед перемешиванием (например, пути из collect_video_tasks). С ними шард
+              каждого видео зависит только от seed, а не от порядка файлов в папках (os.listdir), который
+              на другой файловой системе может отличаться. Без keys используется порядок label_names.
+
+    Возвращает:
+        np.ndarray: Номер шарда для каждого видео.
+    """
+    label_names = np.asarray(label_names)
+    keys = np.asarray(keys) if keys is not None else None
+    rng = np.random.default_rng(seed)
+    shards = np.empty(len(label_names), dtype=np.int64)
+
+    next_shard = 0
+    for label_name in sorted(set(label_names)):
+        positions = np.flatnonzero(label_names == label_name)
+        if keys is not None:
+            positions = positions[np.argsort(keys[positions], kind='stable')]
+        positions = rng.permutation(positions)
+        shards[positions] = (next_shard + np.arange(len(positions))) % n_shards
+        next_shard = (next_shard + len(positions)) % n_shards
+
+    return shards
+
+
+def export_shards(videos, labels, label_names, output_dir, n_shards, seed=0, tasks=None, rois=None, frame_counts=None,
+                  intensity_stats=None):
+    """
+    Делит датасет на n_shards шардов для обучения на нескольких узлах (см. assign_shards; если переданы tasks,
+    видео каждого класса перед перемешиванием сортируются по пути). Каждый шард -
+    папка output_dir/shard_XXX с теми же файлами, что и весь датасет: videos.npy, labels.npy, labels_names.npy
+    и индекс videos_index.csv (save_metadata_index, если переданы tasks), так что узел читает только свою папку.
+    Видео копируются по одному в заранее выделенный .npy (np.memmap), без загрузки всего датасета в память.
+    В output_dir сохраняется shards.csv: номер видео в исходном массиве, шард и номер видео в шарде.
+
+    Параметры:
+        videos: Массив видео load_videos (np.memmap из videos.npy или np.ndarray).
+        tasks (list): Список видео из collect_video_tasks в порядке videos - для индекса каждого шарда.
+        rois (list): Области тела из estimate_body_rois (в порядке tasks) для столбцов roi_* индекса.
+        frame_counts: Настоящее число кадров каждого видео (load_videos(frame_counts=...)) для столбца frames индекса.
+        intensity_stats (IntensityStats): Если передан, общие константы нормализации сохраняются в каждый шард
+                                          (videos_stats.json), чтобы все узлы нормализовали одинаково.
+
+    Возвращает:
+        pd.DataFrame: Содержимое shards.csv.
+    """
+    labels = np.asarray(labels)
+    label_names = np.asarray(label_names)
+    keys = [video_path for video_path, _, _ in tasks] if tasks is not None else None
+    shards = assign_shards(label_names, n_shards, seed, keys)
+    os.makedirs(output_dir, exist_ok=True)
+
+    rows = []
+    for shard in range(n_shards):
+        shard_dir = os.path.join(output_dir, SHARD_DIR_FORMAT.format(shard))
+        os.makedirs(shard_dir, exist_ok=True)
+        indices = np.flatnonzero(shards == shard)
+
+        shard_videos = np.lib.format.open_memmap(os.path.join(shard_dir, 'videos.npy'), mode='w+', dtype=videos.dtype,
+                                                 shape=(len(indices),) + tuple(videos.shape[1:]))
+        for position, i in enumerate(indices):
+            shard_videos[position] = videos[i]
+        shard_videos.flush()
+        del shard_videos
+
+        np.save(os.path.join(shard_dir, 'labels.npy'), labels[indices])
+        np.save(os.path.join(shard_dir, 'labels_names.npy'), label_names[indices])
+        if tasks is not None:
+            save_metadata_index(os.path.join(shard_dir, 'videos_index.csv'), [tasks[i] for i in indices],
+                                np.load(os.path.join(shard_dir, 'videos.npy'), mmap_mode='r'),
+                                [rois[i] for i in indices] if rois is not None else None,
+                                [frame_counts[i] for i in indices] if frame_counts is not None else None)
+        if intensity_stats is not None:
+            intensity_stats.save_json(os.path.join(shard_dir, 'videos_stats.json'))
+
+        rows.extend({'video_index': int(i), 'shard': shard, 'position': position, 'label_name': label_names[i]}
+                    for position, i in enumerate(indices))
+        print(f"Шард {shard}: {len(indices)} видео, {len(set(label_names[indices]))} классов")
+
+    manifest = pd.DataFrame(rows, columns=['video_index', 'shard', 'position', 'label_name'])
+    manifest = manifest.sort_values('video_index').reset_index(drop=True)
+    manifest.to_csv(os.path.join(output_dir, SHARD_MANIFEST_FILE), index=False)
+
+    return manifest
+
+
+class ClipSampler:
+    """
+    Подает в обучение 3D-модели батчи клипов фиксированной длины clip_length, вырезанных вдоль оси кадров
+    из видео load_videos. Видео читаются по одному клипу (np.memmap из .npy, PackedVideos или CompressedVideos),
+    весь датасет в память не загружается. Следующие prefetch батчей собираются заранее в workers потоках, поэтому
+    в памяти одновременно не больше prefetch + 1 батчей, независимо от размера датасета.
+
+    Режимы:
+        'random' - случайное окно в случайном видео; при balanced=True класс (label_names) сначала выбирается
+                   равновероятно, затем видео этого класса. Для обучения.
+        'sliding' - все окна с шагом stride по всем видео по порядку, без перемешивания. Для валидации.
+
+    Пример:
+        sampler = ClipSampler(videos, labels, label_names, clip_length=16, batch_size=8, indices=train_indices)
+        for clips, batch_labels in sampler:
+            ...  # clips: (batch_size, clip_length, высота, ширина[, 1]) uint8, batch_labels: строки labels
+        print(sampler.samples_per_second())
+
+    Параметры:
+        indices: Номера видео, из которых берутся клипы (например, train_indices из split_metadata_index).
+        lengths: Настоящее число кадров каждого видео (например, index['frames'] из save_metadata_index
+                 с frame_counts), чтобы не брать окна из нулевых кадров дополнения. По умолчанию - videos.lengths
+                 или videos.shape[1]. Для np.ndarray / np.memmap lengths не должны превышать videos.shape[1];
+                 если lengths не переданы, выводится предупреждение: окна могут захватывать нулевые кадры дополнения.
+        steps_per_epoch (int): Число батчей за эпоху в режиме 'random' (по умолчанию - видео / batch_size).
+        report_every (int): Если задан, каждые report_every батчей выводится скорость подачи.
+    """
+
+    def __init__(self, videos, labels, label_names, clip_length=16, batch_size=8, indices=None, lengths=None,
+                 mode='random', stride=None, balanced=True, steps_per_epoch=None, prefetch=4, workers=2, seed=0,
+                 report_every=None):
+        if mode not in ('random', 'sliding'):
+            raise ValueError(f"Неизвестный режим выборки клипов: {mode}")
+
+        self.videos = videos
+        self.labels = np.asarray(labels)
+        self.label_names = np.asarray(label_names)
+        self.indices = np.arange(len(videos)) if indices is None else np.asarray(indices, dtype=np.int64)
+        if lengths is None:
+            lengths = getattr(videos, 'lengths', None)
+        self.lengths = (np.asarray(lengths, dtype=np.int64) if lengths is not None
+                        else np.full(len(videos), videos.shape[1], dtype=np.int64))
+        self.frame_shape = tuple(getattr(videos, 'frame_shape', None) or videos.shape[2:])
+        if not hasattr(videos, 'lengths'):
+            self._check_padded_lengths(explicit=lengths is not None)
+
+        self.clip_length = clip_length
+        self.batch_size = batch_size
+        self.mode = mode
+        self.stride = stride or clip_length
+        self.balanced = balanced
+        self.prefetch = prefetch
+        self.workers = workers
+        self.report_every = report_every
+        self.rng = np.random.default_rng(seed)
+
+        by_class = {}
+        for i in self.indices:
+            by_class.setdefault(self.label_names[i], []).append(i)
+        self.class_indices = [np.array(by_class[name], dtype=np.int64) for name in sorted(by_class)]
+
+        if mode == 'sliding':
+            self.windows = [(i, start) for i in self.indices
+                            for start in range(0, max(self.lengths[i] - clip_length, 0) + 1, self.stride)]
+            self.steps_per_epoch = (len(self.windows) + batch_size - 1) // batch_size
+        else:
+            self.steps_per_epoch = steps_per_epoch or max((len(self.indices) + batch_size - 1) // batch_size, 1)
+
+        self.samples = 0
+        self.seconds = 0.0
+        self.wait_seconds = 0.0  # Время, которое обучение ждало батч
+
+    def _check_padded_lengths(self, explicit):
+        # В np.ndarray / np.memmap короткие видео дополнены нулевыми кадрами до videos.shape[1]. По содержимому
+        # массива дополнение не отличить от настоящих черных кадров, поэтому без lengths только предупреждаем
+        depth = self.videos.shape[1]
+        lengths = self.lengths[self.indices]
+        if np.any(lengths > depth):
+            raise ValueError(f"Число кадров видео (lengths, до {lengths.max()}) больше глубины массива {depth}")
+        if not explicit:
+            print(f"Предупреждение: lengths не переданы, все видео считаются длиной {depth} кадров; если видео "
+                  f"дополнены нулевыми кадрами, передайте настоящее число кадров "
+                  f"(load_videos(frame_counts=...), index['frames'])")
+
+    def __len__(self):
+        return self.steps_per_epoch
+
+    def plan_epoch(self):
+        """
+        Возвращает:
+            list: Для каждого батча эпохи - список пар (номер видео, первый кадр клипа).
+        """
+        if self.mode == 'sliding':
+            return [self.windows[i:i + self.batch_size] for i in range(0, len(self.windows), self.batch_size)]
+
+        plan = []
+        for _ in range(self.steps_per_epoch):
+            if self.balanced:
+                classes = self.rng.integers(len(self.class_indices), size=self.batch_size)
+                video_indices = [self.rng.choice(self.class_indices[c]) for c in classes]
+            else:
+                video_indices = self.rng.choice(self.indices, size=self.batch_size)
+            starts = self.rng.integers(0, np.maximum(self.lengths[video_indices] - self.clip_length, 0) + 1)
+            plan.append(list(zip(video_indices, starts)))
+        return plan
+
+    def load_batch(self, batch_plan):
+        """
+        Читает клипы одного батча. Клип короче clip_length (короткое видео) дополняется нулевыми кадрами.
+
+        Возвращает:
+            clips (np.ndarray): Массив формы (число клипов, clip_length, высота, ширина[, 1]) uint8.
+            labels (np.ndarray): Метки видео, из которых взяты клипы.
+        """
+        clips = np.zeros((len(batch_plan), self.clip_length) + self.frame_shape, dtype=np.uint8)
+        for k, (i, start) in enumerate(batch_plan):
+            stop = min(start + self.clip_length, self.lengths[i])
+            clips[k, :stop - start] = self.videos[i][start:stop]
+        return clips, self.labels[[i for i, _ in batch_plan]]
+
+    def samples_per_second(self):
+        # Скорость подачи за время всех эпох: клипов в секунду
+        return self.samples / self.seconds if self.seconds > 0 else 0.0
+
+    def __iter__(self):
+        plan = self.plan_epoch()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = [executor.submit(self.load_batch, batch_plan) for batch_plan in plan[:self.prefetch]]
+            for batch_number in range(len(plan)):
+                if batch_number + self.prefetch < len(plan):
+                    pending.append(executor.submit(self.load_batch, plan[batch_number + self.prefetch]))
+
+                wait_start = time.perf_counter()
+                clips, batch_labels = pending.pop(0).result()
+                self.wait_seconds += time.perf_counter() - wait_start
+                self.samples += len(clips)
+                self.seconds += time.perf_counter() - start
+                start = time.perf_counter()
+
+                if self.report_every and (batch_number + 1) % self.report_every == 0:
+                    print(f"Батч {batch_number + 1}/{len(plan)}: {self.samples_per_second():.1f} клипов/с, "
+                          f"ожидание данных {self.wait_seconds:.1f} с")
+
+                yield clips, batch_labels
+
+
+if __name__ == "__main__":
+    # create_folder_structure(r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture')
+    # test_download_and_display_single_video(r"C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\База данных МСКТ надпочечников_MP4.xlsx", column_names=['Файл c нативной фазой'])
+    # failed_downloads = download_videos_from_excel(r"C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\База данных МСКТ надпочечников_MP4.xlsx",
+    #                                               r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Все видео', workers=8)
+
+    video_path = r"C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\data\class02\ID5_NATIVE_SE1.mp4"
+    # display_video(video_path,frame_skip=5, wait_key=200)
+    # display_video_with_max_contour(video_path, frame_skip=5, wait_key=500) # не работает пока
+    # display_video_with_center(video_path, frame_skip=5)
+
+    data_dir = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture\data'
+    # videos, labels, label_names = load_videos(data_dir, target_size=(224, 224), frame_skip=5, add_third_dimension=True)
+    # Несколько размеров за одно декодирование: videos - словарь {(ширина, высота): массив}
+    # videos, labels, label_names = load_videos(data_dir, target_size=[(224, 224), (160, 160), (112, 112)], frame_skip=5)
+    # print(labels, label_names)
+
+
+    image_dir = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Все картинки'  # Путь к папке с картинками
+    excel_file = r"C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\База данных МСКТ надпочечников_MP4.xlsx"  # Путь к Excel-файлу
+
+    # missing_images = check_images_in_excel(image_dir, excel_file)
+    # # Печать картинок, которых нет в Excel
+    # print("Картинки, не найденные в Excel:", missing_images)
+
+
+    # проверял смещение
+    # image_dir = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Все картинки'
+    # manual_directory_check(image_dir)
+
+
+
+    # data_dir = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture\data'
+    # videos, labels, labels_names = load_videos(data_dir)
 
 # """
 #     data_dir = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture\data'
@@ -506,25 +3131,62 @@ if __name__ == "__main__":
 #----------------Преобразование данных----------------#
 
     data_dir = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture\data'
-    videos, labels, labels_names = load_videos(data_dir, target_size=(224, 224), frame_skip=2, add_third_dimension=True)
-
-    print(f"Форма массива видео: {videos.shape}")
-    # print(f"Метки: {labels}")
-    # print(f"Имена меток: {labels_names}")
-
-
 
     # Пути для сохранения файлов
     videos_file = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture\videos.npy'
     labels_file = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture\labels.npy'
     labels_names_file = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture\labels_names.npy'
+    cache_dir = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture\cache'
+
+    # Повторяющиеся исследования (одна серия в нескольких классах или под разными именами).
+    # Поиск декодирует кадры всех видео, поэтому запускается отдельно, после добавления новых исследований.
+    # Чтобы не загружать дубликаты, передать duplicates_report=duplicates_file в load_videos и collect_video_tasks
+    # duplicates_file = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture\duplicates.csv'
+    # find_duplicate_videos(data_dir, duplicates_file)
+
+    # Кадры пишутся сразу в videos_file, без сборки всего массива в памяти.
+    # Декодируются только видео, которых еще нет в кэше
+    # Область тела для каждого исследования: кадры обрезаются по ней вместо всей половины кадра.
+    # Как и кадры, оценивается только для видео, которых еще нет в кэше
+    tasks = collect_video_tasks(data_dir)
+    rois = estimate_body_rois(tasks, target_size=(224, 224), cache_dir=cache_dir)
+
+    # Статистика яркости для нормализации считается во время загрузки и сохраняется рядом с массивами
+    # Настоящее число кадров каждого видео (в videos_file короткие видео дополнены нулевыми кадрами)
+    intensity_stats = IntensityStats()
+    frame_counts = []
+    videos, labels, labels_names = load_videos(data_dir, target_size=(224, 224), frame_skip=2, add_third_dimension=True,
+                                               output_file=videos_file, cache_dir=cache_dir, rois=rois,
+                                               intensity_stats=intensity_stats, frame_counts=frame_counts)
+
+    print(f"Форма массива видео: {videos.shape}")
+    # print(f"Метки: {labels}")
+    # print(f"Имена меток: {labels_names}")
 
-    np.save(videos_file, videos)
     np.save(labels_file, labels)
     np.save(labels_names_file, labels_names)
+    intensity_stats.save_json(r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture\videos_stats.json')
+
+    # Индекс для статистики датасета без загрузки videos.npy
+    index_file = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture\videos_index.csv'
+    save_metadata_index(index_file, tasks, videos, rois, frame_counts)
 
     print("Массивы успешно сохранены.")
 
+    # Сжатый формат с доступом к отдельному видео (удобно копировать на узлы обучения)
+    # compressed_file = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture\videos_compressed.npz'
+    # save_compressed_videos(videos, labels, labels_names, compressed_file, chunk_frames=16)
+
+    # Шарды для обучения на нескольких узлах: каждый узел копирует и читает только свою папку shard_XXX
+    # shards_dir = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture\shards'
+    # export_shards(videos, labels, labels_names, shards_dir, n_shards=4, seed=0, tasks=tasks, rois=rois,
+    #               frame_counts=frame_counts, intensity_stats=intensity_stats)
+
+    # Упакованный формат: видео с разным числом кадров, чтение одного исследования без загрузки всего датасета
+    # packed_dir = r'C:\Users\Антон\Documents\материалы ВИШ\Диплом КТ\Adrenal CT architecture\videos_packed'
+    # packed = save_packed_videos(data_dir, packed_dir, target_size=(224, 224), frame_skip=2, add_third_dimension=True)
+    # print(f"Число видео: {len(packed)}, форма первого видео: {packed[0].shape}")
+
 
 
 #----------------Загрузка массивов данных----------------#